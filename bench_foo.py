@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_foo
+    ~~~~~~~~~
+
+    Benchmarks for foo. Run with ``python bench_foo.py``.
+
+    :copyright: (c) 2013 by Rafael Goncalves Martins
+    :license: BSD, see LICENSE for more details.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from foo import BashModule
+from test_foo import EXAMPLE_RECORDS, StubDNSServer, dns_engine
+
+
+def timeit(func, runs):
+    timings = []
+    for i in range(runs):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return sorted(timings)
+
+
+def report(name, timings):
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+    print '%-36s p50 %8.2fms  p90 %8.2fms  p99 %8.2fms' % (
+        name, percentile(0.5), percentile(0.9), percentile(0.99))
+
+
+def bench_launcher(tmpdir, args):
+    module = os.path.join(tmpdir, 'module')
+    with open(module, 'w') as fp:
+        print >> fp, 'FOO_HELP="dummy"'
+        print >> fp, 'main() { log_debug "lol"; }'
+    inline = BashModule(module)
+    compiled = BashModule(module,
+                          compile_dir=os.path.join(tmpdir, 'compiled'))
+    compiled.compile()
+    module_args = {'log_level': '30'}
+    report('module run, inline script',
+           timeit(lambda: inline.run(module_args), args.runs))
+    report('module run, compiled launcher',
+           timeit(lambda: compiled.run(module_args), args.runs))
+
+
+def bench_resolver(tmpdir, args):
+    records = dict(EXAMPLE_RECORDS)
+    hostnames = ['host%03d.example.com' % i for i in range(100)]
+    for hostname in hostnames:
+        records[(hostname, 'CNAME')] = [(300, 'example.com')]
+    server = StubDNSServer(records)
+    resolver = dns_engine['Resolver']([server.address])
+    dns_resolve = dns_engine['dns_resolve']
+    try:
+        report('dns resolve, 1 host',
+               timeit(lambda: dns_resolve(resolver, ['www.example.com']),
+                      args.runs))
+        report('dns resolve, 100 hosts',
+               timeit(lambda: dns_resolve(resolver, hostnames), args.runs))
+    finally:
+        resolver.close()
+        server.close()
+
+
+# FOO_USAGE of the synthetic modules, from trivial to complex
+FARM_USAGES = [
+    '',
+    'value',
+    '[--verbose] [--output=file] value',
+    '[--verbose] [--quiet] [--format=name] [--output=file] [--jobs=number] '
+    '[--timeout=seconds] --input=file source [destination]',
+]
+
+
+def build_farm(tmpdir, size):
+    # a copy of foo with size modules spread over its user, local and egg
+    # search paths. one in ten modules has dynamic metadata, that needs
+    # sourcing, and one in twenty is a python module.
+    foo = os.path.join(tmpdir, 'foo.py')
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'foo.py'), foo)
+    home = os.path.join(tmpdir, 'home')
+    dirs = [os.path.join(home, '.local', 'libexec', 'foo-tools'),
+            os.path.join(tmpdir, 'modules'),
+            os.path.join(tmpdir, 'libexec', 'foo-tools')]
+    for dirname in dirs:
+        os.makedirs(dirname)
+    for i in range(size):
+        name = os.path.join(dirs[i % len(dirs)], 'module%04d' % i)
+        usage = FARM_USAGES[i % len(FARM_USAGES)]
+        if i % 20 == 19:
+            with open(name + '.py', 'w') as fp:
+                print >> fp, 'FOO_HELP = "synthetic module %d"' % i
+                print >> fp, 'FOO_USAGE = %r' % usage
+                print >> fp, 'def main(args):'
+                print >> fp, '    return 0'
+            continue
+        with open(name, 'w') as fp:
+            if i % 10 == 9:
+                print >> fp, 'FOO_HELP="synthetic module $((%d))"' % i
+            else:
+                print >> fp, 'FOO_HELP="synthetic module %d"' % i
+            print >> fp, 'FOO_USAGE="%s"' % usage
+            print >> fp, 'main() { log_debug "module %d"; }' % i
+    env = dict(os.environ, HOME=home,
+               FOO_CACHE_DIR=os.path.join(tmpdir, 'cache'))
+    for key in ['FOO_CLIENT', 'FOO_PROFILE', 'XDG_CACHE_HOME']:
+        env.pop(key, None)
+    return foo, env
+
+
+def bench_farm(tmpdir, args):
+    # foo startup with synthetic module farms of growing size. cold runs
+    # start without any cache, warm runs reuse the cache of the previous
+    # run. the last row of each farm is the bash module run directly,
+    # without foo.
+    devnull = open(os.devnull, 'w')
+
+    def call(cmd, env, cold=False):
+        def func():
+            if cold:
+                shutil.rmtree(env['FOO_CACHE_DIR'], ignore_errors=True)
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+        return func
+
+    try:
+        for size in args.farm_sizes:
+            farm = os.path.join(tmpdir, 'farm%d' % size)
+            os.makedirs(farm)
+            foo, env = build_farm(farm, size)
+            help = [sys.executable, foo, '--help']
+            module = [sys.executable, foo, 'module0000']
+            direct = ['/bin/bash', '-c', 'log_debug() { :; }; '
+                      'source %s > /dev/null; main' %
+                      os.path.join(farm, 'home', '.local', 'libexec',
+                                   'foo-tools', 'module0000')]
+            for name, func in [('foo --help, cold', call(help, env, True)),
+                               ('foo --help, warm', call(help, env)),
+                               ('foo <module>, cold',
+                                call(module, env, True)),
+                               ('foo <module>, warm', call(module, env)),
+                               ('bash <module>', call(direct, env))]:
+                report('%d modules, %s' % (size, name),
+                       timeit(func, args.runs))
+    finally:
+        devnull.close()
+
+
+BENCHMARKS = [('launcher', bench_launcher), ('resolver', bench_resolver),
+              ('farm', bench_farm)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for foo.')
+    parser.add_argument('--runs', type=int, default=50,
+                        help='number of runs of each benchmark.')
+    parser.add_argument('--farm-sizes', metavar='N,...',
+                        default=[10, 100, 1000],
+                        type=lambda value: [int(i) for i in value.split(',')],
+                        help='numbers of modules of the synthetic farms.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run (%s).' % ', '.join(
+                            [i for i, j in BENCHMARKS]))
+    args = parser.parse_args()
+    for name, func in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        tmpdir = tempfile.mkdtemp()
+        try:
+            func(tmpdir, args)
+        finally:
+            shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,32 +19,76 @@ __license__ = 'BSD'
 
 __version__ = '0.1pre'
 
-try:
-    import argparse
-except ImportError:  # Python 2.6, will be installed by setup.py
-    pass
+import errno
+import fcntl
 import logging
 import os
 import re
+import resource
+import select
 import shlex
-import subprocess
+import signal
+import struct
 import sys
 import sysconfig
+import threading
+import time
+from cStringIO import StringIO
 
-re_parse_args = re.compile(
-    r'^(?P<lopt>\[)?('
-    r'(?P<key>\-\-(?P<key_name>[a-z_-]+))(=(?P<value>[a-z_-]+))?|'
-    r'(?P<argument>[a-z_-]+))'
-    r'(?P<ropt>\])?$')
+# the other modules are imported by the functions that use them, to keep them
+# out of the startup of the code paths that don't, like --version and shell
+# completion. argparse is also installed by setup.py on python 2.6, after
+# importing foo.
+
+_re_parse_args = None
+
+
+def get_re_parse_args():
+    # compiled on first use, only needed to build the parser of a module
+    global _re_parse_args
+    if _re_parse_args is None:
+        _re_parse_args = re.compile(
+            r'^(?P<lopt>\[)?('
+            r'(?P<key>\-\-(?P<key_name>[a-z_-]+))(=(?P<value>[a-z_-]+))?|'
+            r'(?P<argument>[a-z_-]+))'
+            r'(?P<ropt>\])?$')
+    return _re_parse_args
+
+
+re_bash_assignment = re.compile(
+    r'^(?P<name>[A-Za-z_][A-Za-z0-9_]*)=(?P<value>.*)$')
+re_bash_foo_var = re.compile(r'(?<![A-Za-z0-9_])FOO_[A-Za-z0-9_]*')
+re_bash_var_ref = re.compile(
+    r'\$(\{(?P<braced>[A-Za-z_][A-Za-z0-9_]*)\}|'
+    r'(?P<name>[A-Za-z_][A-Za-z0-9_]*))')
+re_bash_source = re.compile(r'(^|[;&|({]\s*)(source|eval|\.)(\s|$)')
+re_python_shebang = re.compile(r'^#!.*\bpython')
 
 LOG_FORMAT = '%(name)s - %(levelname)s: %(message)s'
 
 BASH_LIST_VARS = '''\
+unset $(compgen -A variable FOO_)
 source "%(module)s" &> /dev/null
 for i in $(compgen -A variable FOO_); do
     echo $i=\\""${!i}"\\"
 done'''
 
+BASH_LIST_VARS_BATCH = '''\
+i=0
+for module in "$@"; do
+    echo "%(delimiter)s begin ${i}"
+    (
+%(list_vars)s
+    )
+    echo "%(delimiter)s end ${i} $?"
+    i=$((i + 1))
+done'''
+
+MODULE_INDEX = '.foo-index'
+
+# minimum number of modules sourced by each bash process in batch mode
+BATCH_MIN_SIZE = 8
+
 BASH_LOGGING = '''\
 log_%(levelname_lower)s() {
     if [[ ${FOO_ARG_LOG_LEVEL:-30} -le %(levelno)d ]]; then
@@ -53,12 +97,42 @@ log_%(levelname_lower)s() {
 }
 '''
 
-BASH_RUN_MODULE = '''\
+BASH_DIE = '''\
 die() {
     log_critical $@
     exit 1
 }
+'''
+
+BASH_RUN_MODULE = BASH_DIE + '''\
+source "%(module)s" > /dev/null
+main'''
+
+BASH_FOO = '''\
+foo() {
+    %(python)s %(foo)s "$@"
+}
+'''
+
+BASH_LAUNCHER = '''\
+#!/bin/bash
+# foo %(version)s launcher for %(module)s
+FOO_MODULE_NAME="%(modulename)s"
+source "%(prelude)s"
 source "%(module)s" > /dev/null
+main
+'''
+
+BASH_WORKER = '''\
+%(prelude)s
+IFS= read -r -d '' _foo_job || exit 1
+eval "${_foo_job}"'''
+
+BASH_WORKER_JOB = '''\
+cd %(cwd)s || exit 1
+export %(env)s
+FOO_MODULE_NAME=%(modulename)s
+source %(module)s > /dev/null
 main'''
 
 log = logging.getLogger('foo')
@@ -68,36 +142,848 @@ log.addHandler(_log_handler)
 log.setLevel(logging.WARNING)
 
 
-class BashModule(object):
+def get_cache_dir():
+    cache_dir = os.environ.get('FOO_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'foo-tools')
+
+
+def write_file(fname, content, mode=0644):
+    # writes the file atomically, creating its directory if needed.
+    import tempfile
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(content)
+    os.chmod(tmp, mode)
+    os.rename(tmp, fname)
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _Phase(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        local = self.profiler.local
+        self.depth = getattr(local, 'depth', 0)
+        local.depth = self.depth + 1
+        self.record = {'name': self.name, 'depth': self.depth}
+        self.profiler.phases.append(self.record)
+        self.start = time.time(), _cpu_time()
+
+    def __exit__(self, *exc_info):
+        self.record['wall'] = time.time() - self.start[0]
+        self.record['cpu'] = _cpu_time() - self.start[1]
+        self.profiler.local.depth = self.depth
+
+
+class Profiler(object):
+
+    # records the wall and cpu time spent in each phase of a run, and the
+    # resource usage of the child processes. phases may be nested. cpu time
+    # is accounted for the whole process, including other threads. a
+    # disabled profiler just hands out a shared no-op phase.
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.children = None
+        self.local = None
+        self.start = None
+
+    def enable(self):
+        self.enabled = True
+        self.local = threading.local()
+        self.phases = []
+        self.children = None
+        self.start = time.time(), _cpu_time()
+
+    def disable(self):
+        self.enabled = False
 
-    def __init__(self, fname):
+    def phase(self, name):
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name)
+
+    def children_usage(self):
+        # returns a snapshot of the resource usage of the finished children.
+        # the difference of two snapshots is stored by set_children.
+        return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def set_children(self, before):
+        after = self.children_usage()
+        self.children = {
+            'user': after.ru_utime - before.ru_utime,
+            'sys': after.ru_stime - before.ru_stime,
+            # the peak of the biggest child so far, in kilobytes
+            'maxrss': after.ru_maxrss,
+            'voluntary_switches': after.ru_nvcsw - before.ru_nvcsw,
+            'involuntary_switches': after.ru_nivcsw - before.ru_nivcsw,
+        }
+
+    def report(self):
+        return {'wall': time.time() - self.start[0],
+                'cpu': _cpu_time() - self.start[1],
+                'phases': [i for i in self.phases if 'wall' in i],
+                'children': self.children}
+
+    def format(self, fmt='text'):
+        import json
+        report = self.report()
+        if fmt == 'json':
+            return json.dumps(report, sort_keys=True)
+        lines = ['%-50s %10s %10s' % ('phase', 'wall', 'cpu')]
+        for phase in report['phases']:
+            name = '  ' * phase['depth'] + phase['name']
+            lines.append('%-50s %8.2fms %8.2fms' % (
+                name[:50], phase['wall'] * 1000, phase['cpu'] * 1000))
+        lines.append('%-50s %8.2fms %8.2fms' % (
+            'total', report['wall'] * 1000, report['cpu'] * 1000))
+        children = report['children']
+        if children is not None:
+            lines.append('children: user %.2fms, sys %.2fms, max rss %dkB, '
+                         'context switches %d voluntary, %d involuntary' % (
+                             children['user'] * 1000, children['sys'] * 1000,
+                             children['maxrss'],
+                             children['voluntary_switches'],
+                             children['involuntary_switches']))
+        return '\n'.join(lines)
+
+
+_null_phase = _NullPhase()
+profiler = Profiler()
+
+
+def bash_logging(modulename):
+    script = ''
+    for levelno, levelname in logging._levelNames.iteritems():
+        if not isinstance(levelname, basestring):
+            continue
+        if levelname == 'NOTSET':
+            continue
+        script += BASH_LOGGING % {'levelname': levelname,
+                                  'levelname_lower': levelname.lower(),
+                                  'levelno': levelno, 'name': 'foo',
+                                  'modulename': modulename}
+    return script
+
+
+def bash_foo():
+    # lets modules call foo itself, with the same python and foo.py.
+    import pipes
+    fname = os.path.abspath(__file__)
+    if fname.endswith(('.pyc', '.pyo')):
+        fname = fname[:-1]
+    return BASH_FOO % {'python': pipes.quote(sys.executable),
+                       'foo': pipes.quote(fname)}
+
+
+def compile_prelude(compile_dir):
+    # writes the logging functions and die() shared by all the launchers.
+    # the file name carries a hash of its content.
+    import hashlib
+    prelude = bash_logging('${FOO_MODULE_NAME}') + bash_foo() + BASH_DIE
+    fname = os.path.join(compile_dir, 'prelude-%s.bash' %
+                         hashlib.sha1(prelude).hexdigest()[:12])
+    if not os.path.isfile(fname):
+        write_file(fname, prelude)
+    return fname
+
+
+def _expand_bash_var(value, pos, variables):
+    # expands the reference at value[pos] (a '$'). returns a tuple with the
+    # expanded text and the new position, or None for anything but a plain
+    # reference to a FOO_ variable.
+    rv = re_bash_var_ref.match(value, pos)
+    if rv is None:
+        if pos + 1 == len(value) or value[pos + 1] in ' \t"':
+            return '$', pos + 1
+        return None
+    name = rv.group('braced') or rv.group('name')
+    if not name.startswith('FOO_'):
+        return None
+    return variables.get(name, ''), rv.end()
+
+
+def parse_bash_value(value, variables):
+    # evaluates the right side of a bash assignment, if it only contains
+    # literals, quoting and references to FOO_ variables. returns None
+    # otherwise.
+    rv = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "'":
+            end = value.find("'", i + 1)
+            if end < 0:
+                return None
+            rv.append(value[i + 1:end])
+            i = end + 1
+        elif c == '"':
+            i += 1
+            while True:
+                if i >= len(value):
+                    return None
+                c = value[i]
+                if c == '"':
+                    i += 1
+                    break
+                elif c == '\\' and value[i + 1:i + 2] in ['$', '`', '"',
+                                                           '\\']:
+                    rv.append(value[i + 1])
+                    i += 2
+                elif c == '$':
+                    expanded = _expand_bash_var(value, i, variables)
+                    if expanded is None:
+                        return None
+                    rv.append(expanded[0])
+                    i = expanded[1]
+                elif c == '`':
+                    return None
+                else:
+                    rv.append(c)
+                    i += 1
+        elif c == '\\':
+            if i + 1 >= len(value):
+                return None
+            rv.append(value[i + 1])
+            i += 2
+        elif c == '$':
+            expanded = _expand_bash_var(value, i, variables)
+            if expanded is None:
+                return None
+            rv.append(expanded[0])
+            i = expanded[1]
+        elif c in ' \t':
+            rest = value[i:].lstrip()
+            if rest and not rest.startswith('#'):
+                return None
+            break
+        elif c in ';&|<>()`' or (c == '~' and (i == 0 or value[i - 1] == ':')):
+            return None
+        else:
+            rv.append(c)
+            i += 1
+    return ''.join(rv)
+
+
+def parse_metadata(fname):
+    # extracts metadata from the plain FOO_* assignments at the top of a
+    # bash module, without spawning bash. returns None if the module does
+    # anything else with FOO_ variables, meaning that it must be sourced.
+    try:
+        with open(fname) as fp:
+            content = fp.read()
+    except IOError:
+        return None
+    variables = {}
+    header = True
+    for line in content.replace('\\\n', '').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if re_bash_source.search(line) is not None:
+            return None
+        rv = re_bash_assignment.match(line)
+        if header and rv is not None:
+            name = rv.group('name')
+            if name.startswith('FOO_'):
+                value = parse_bash_value(rv.group('value'), variables)
+                if value is None:
+                    return None
+                variables[name] = value
+                continue
+        else:
+            header = False
+        for var in re_bash_foo_var.finditer(line):
+            if line == var.group(0):  # plain command
+                continue
+            prefix = line[:var.start()]
+            if not prefix.endswith(('$', '${', '${!', '${#')):
+                return None
+    metadata = {}
+    for name, value in variables.iteritems():
+        metadata[name.lower()[4:]] = value
+    return metadata
+
+
+class JSONCache(object):
+
+    version = 1
+    description = 'cache'
+
+    def __init__(self, fname, rebuild=False):
         self.fname = fname
-        self.name = os.path.basename(self.fname)
+        self.data = {}
+        self.dirty = rebuild
+        if not rebuild:
+            self.load()
+
+    def load(self):
+        import json
+        try:
+            with open(self.fname) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.data = data
+
+    def save(self):
+        # The code below can't use any log level lower than WARNING
+        import json
+        if not self.dirty:
+            return
+        try:
+            write_file(self.fname,
+                       json.dumps(dict(self.data, version=self.version)))
+        except (IOError, OSError), e:
+            log.warning('Failed to save %s: %s' % (self.description, e))
+            return
+        self.dirty = False
 
-    def get_metadata(self):
+
+class MetadataCache(JSONCache):
+
+    # entries are keyed by module path and validated against the module's
+    # mtime, size and inode, so any change to the module invalidates them.
+    description = 'metadata cache'
+
+    @property
+    def entries(self):
+        return self.data.setdefault('modules', {})
+
+    def stat(self, module_file):
+        try:
+            st = os.stat(module_file)
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size, st.st_ino]
+
+    def get(self, module_file, key):
+        entry = self.entries.get(module_file)
+        if entry is None or key is None or entry['key'] != key:
+            return None
+        # json gives unicode strings, but the metadata parsed from the
+        # modules is utf-8 encoded, like the module names of ModuleIndex.
         metadata = {}
-        script = BASH_LIST_VARS % {'module': self.fname}
-        rv = subprocess.check_output(['/bin/bash', '-c', script])
-        for line in shlex.split(rv):
-            pieces = line.split('=', 1)
-            metadata[pieces[0].lower()[4:]] = pieces[1]
+        for name, value in entry['metadata'].iteritems():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            metadata[name.encode('utf-8')] = value
         return metadata
 
+    def set(self, module_file, key, metadata):
+        if key is None:
+            return
+        self.entries[module_file] = {'key': key, 'metadata': metadata}
+        self.dirty = True
+
+    def prune(self, module_files):
+        module_files = set(module_files)
+        for module_file in list(self.entries.keys()):
+            if module_file not in module_files:
+                del self.entries[module_file]
+                self.dirty = True
+
+
+def module_kind(fname):
+    # python modules are recognized by the extension or the shebang
+    if fname.endswith('.py'):
+        return 'python'
+    try:
+        with open(fname) as fp:
+            if re_python_shebang.match(fp.readline(128)) is not None:
+                return 'python'
+    except IOError:
+        pass
+    return 'bash'
+
+
+def list_modules(path):
+    # returns a dict with the kind of each module file in a directory
+    modules = {}
+    for i in os.listdir(path):
+        fname = os.path.join(path, i)
+        if i != MODULE_INDEX and os.path.isfile(fname):
+            modules[i] = module_kind(fname)
+    return modules
+
+
+def write_module_index(path):
+    # writes the index of the modules available in a directory, to be used
+    # while the directory isn't changed after the index.
+    import json
+    modules = list_modules(path)
+    with open(os.path.join(path, MODULE_INDEX), 'w') as fp:
+        json.dump(modules, fp)
+    return modules
+
+
+def read_module_index(path, mtime):
+    import json
+    fname = os.path.join(path, MODULE_INDEX)
+    try:
+        if os.stat(fname).st_mtime < mtime:
+            return None
+        with open(fname) as fp:
+            modules = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if isinstance(modules, dict):
+        return modules
+
+
+class ModuleIndex(JSONCache):
+
+    # the modules found in each search path and the resolved modules are
+    # revalidated from the mtimes of the search paths alone. listings taken
+    # less than a second after a directory changed are not stored, as
+    # further changes in the same second wouldn't change its mtime.
+    version = 2
+    description = 'module index'
+
+    def listdir(self, path, mtime, persist):
+        paths = self.data.setdefault('paths', {})
+        entry = paths.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry['modules']
+        modules = read_module_index(path, mtime)
+        if modules is None:
+            modules = list_modules(path)
+        if persist:
+            paths[path] = {'mtime': mtime, 'modules': modules}
+            self.dirty = True
+        return modules
+
+    def resolve(self, search_paths):
+        # returns a dict with the file name and kind of each module, from
+        # its winning search path. 'foo.py' wins over 'foo' in the same
+        # search path.
+        signature = []
+        persist = True
+        now = time.time()
+        for path in search_paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            else:
+                persist = persist and mtime < now - 1
+            signature.append([path, mtime])
+        resolved = self.data.get('resolved')
+        if resolved is not None and resolved['signature'] == signature:
+            modules = resolved['modules']
+        else:
+            modules = {}
+            for path, mtime in signature[::-1]:
+                if mtime is None:
+                    continue
+                listing = self.listdir(path, mtime,
+                                       persist and mtime < now - 1)
+                for module in sorted(listing.keys()):
+                    name = module
+                    if listing[module] == 'python' and name.endswith('.py'):
+                        name = name[:-3]
+                    modules[name] = [os.path.join(path, module),
+                                     listing[module]]
+            if persist:
+                self.data['resolved'] = {'signature': signature,
+                                         'modules': modules}
+                self.data['paths'] = dict(
+                    i for i in self.data.get('paths', {}).iteritems()
+                    if i[0] in search_paths)
+                self.dirty = True
+        rv = {}
+        for name, (fname, kind) in modules.iteritems():
+            rv[name.encode('utf-8')] = (fname.encode('utf-8'), str(kind))
+        return rv
+
+
+class ResultCache(object):
+
+    # stdout and exit status of module runs, for modules that declare
+    # FOO_CACHE_TTL. each entry is a file named by its key, with the exit
+    # status in the first line, and is fresh for ttl seconds after being
+    # written. the oldest entries are removed when the total size goes over
+    # max_size bytes.
+
+    def __init__(self, dirname, max_size=64 * 1024 * 1024):
+        self.dirname = dirname
+        self.max_size = max_size
+
+    def key(self, module, env):
+        import hashlib
+        with open(module.fname, 'rb') as fp:
+            content = hashlib.sha1(fp.read()).hexdigest()
+        return hashlib.sha1(repr([__version__, module.fname, content,
+                                  sorted([(i, j) for i, j in env.iteritems()
+                                          if i.startswith('FOO_ARG_')])])
+                            ).hexdigest()
+
+    def get(self, key, ttl):
+        # returns (status, stdout), or None if there's no fresh entry.
+        fname = os.path.join(self.dirname, key)
+        try:
+            if os.stat(fname).st_mtime + ttl <= time.time():
+                return None
+            with open(fname, 'rb') as fp:
+                status = int(fp.readline())
+                return status, fp.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, status, stdout):
+        try:
+            write_file(os.path.join(self.dirname, key),
+                       '%d\n%s' % (status, stdout))
+            self.evict()
+        except (IOError, OSError), e:
+            log.warning('Failed to save result cache: %s' % e)
+
+    def evict(self):
+        entries = []
+        for i in os.listdir(self.dirname):
+            try:
+                st = os.stat(os.path.join(self.dirname, i))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, i))
+        size = sum([i[1] for i in entries])
+        for mtime, entry_size, i in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.dirname, i))
+            except OSError:
+                continue
+            size -= entry_size
+
+
+class Slots(object):
+
+    # host-wide limits of modules running at once. each group of slots is a
+    # directory with one file per slot, and a process holds a slot while it
+    # holds an exclusive flock(2) on its file, so slots of crashed processes
+    # are released by the kernel. processes waiting for a slot hold a lock
+    # on a file of the queue directory of the group, so they can be counted.
+    # waiters poll for a free slot, in no particular order.
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def try_lock(self, fname, flags=fcntl.LOCK_EX):
+        # returns a descriptor holding the lock, or None if it is taken.
+        fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, flags | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return fd
+
+    def try_acquire(self, dirname, limit):
+        import random
+        slots = range(limit)
+        random.shuffle(slots)
+        for i in slots:
+            fd = self.try_lock(os.path.join(dirname, 'slot%d' % i))
+            if fd is not None:
+                return fd
+
+    def set_limit(self, dirname, limit):
+        fname = os.path.join(dirname, 'limit')
+        try:
+            with open(fname) as fp:
+                if fp.read().strip() == str(limit):
+                    return
+        except IOError:
+            pass
+        write_file(fname, '%d\n' % limit)
+
+    def enqueue(self, dirname):
+        # the queue file is locked before getting its final name, so that a
+        # file that isn't locked always belongs to a dead process.
+        import tempfile
+        queue = os.path.join(dirname, 'queue')
+        if not os.path.isdir(queue):
+            os.makedirs(queue)
+        fd, tmp = tempfile.mkstemp(dir=queue, prefix='.tmp-')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        fname = os.path.join(queue, '%d-%s' % (os.getpid(),
+                                               os.path.basename(tmp)[5:]))
+        os.rename(tmp, fname)
+        return fd, fname
+
+    def acquire(self, group, limit, timeout=None, inherit=False):
+        # returns a descriptor holding a slot of the group, waiting up to
+        # timeout seconds for it. with inherit=True the descriptor, and the
+        # slot, survive an exec.
+        dirname = os.path.join(self.dirname, group)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.set_limit(dirname, limit)
+        fd = self.try_acquire(dirname, limit)
+        if fd is None:
+            log.info('Waiting for a free slot of %s' % group)
+            queue_fd, queue_fname = self.enqueue(dirname)
+            try:
+                fd = self.wait(dirname, limit, timeout)
+            finally:
+                os.unlink(queue_fname)
+                os.close(queue_fd)
+            if fd is None:
+                raise RuntimeError('Timed out waiting for a free slot of %s '
+                                   '(limit: %d)' % (group, limit))
+        if not inherit:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return fd
+
+    def wait(self, dirname, limit, timeout=None):
+        import random
+        deadline = timeout is not None and time.time() + timeout or None
+        delay = 0.01
+        while True:
+            fd = self.try_acquire(dirname, limit)
+            if fd is not None:
+                return fd
+            now = time.time()
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                delay = min(delay, deadline - now)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 0.25)
+
+    def acquire_all(self, limits, timeout=None, inherit=False):
+        # limits is a list of (group, limit), always acquired in the same
+        # order by every process.
+        fds = []
+        try:
+            for group, limit in limits:
+                fds.append(self.acquire(group, limit, timeout, inherit))
+        except:
+            self.release(fds)
+            raise
+        return fds
+
+    def release(self, fds):
+        for fd in fds:
+            os.close(fd)
+
+    def groups(self):
+        groups = []
+        for name in ['global', 'modules']:
+            dirname = os.path.join(self.dirname, name)
+            if not os.path.isdir(dirname):
+                continue
+            if name == 'global':
+                groups.append(name)
+                continue
+            for i in sorted(os.listdir(dirname)):
+                groups.append('modules/%s' % i)
+        return groups
+
+    def status(self):
+        # returns a list of dicts with the limit, and the numbers of running
+        # and queued processes of each group of slots. checking a slot takes
+        # its lock for a moment, that may make a process wait a bit longer.
+        rv = []
+        for group in self.groups():
+            dirname = os.path.join(self.dirname, group)
+            try:
+                with open(os.path.join(dirname, 'limit')) as fp:
+                    limit = int(fp.read())
+            except (IOError, ValueError):
+                continue
+            running = 0
+            for i in os.listdir(dirname):
+                if not i.startswith('slot'):
+                    continue
+                fd = self.try_lock(os.path.join(dirname, i),
+                                   fcntl.LOCK_SH)
+                if fd is None:
+                    running += 1
+                else:
+                    os.close(fd)
+            queued = 0
+            queue = os.path.join(dirname, 'queue')
+            for i in os.path.isdir(queue) and os.listdir(queue) or []:
+                if i.startswith('.'):
+                    continue
+                fname = os.path.join(queue, i)
+                fd = self.try_lock(fname, fcntl.LOCK_SH)
+                if fd is None:
+                    queued += 1
+                    continue
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+                os.close(fd)
+            rv.append({'group': group, 'limit': limit, 'running': running,
+                       'queued': queued})
+        return rv
+
+
+def _parse_var_list(output):
+    metadata = {}
+    for line in shlex.split(output):
+        pieces = line.split('=', 1)
+        metadata[pieces[0].lower()[4:]] = pieces[1]
+    return metadata
+
+
+def source_metadata_batch(fnames):
+    # sources several modules with a single bash process, each one in its
+    # own subshell. returns a dict with the metadata of the modules that
+    # were sourced successfully, keyed by file name.
+    import subprocess
+    delimiter = '--foo-%s--' % os.urandom(16).encode('hex')
+    script = BASH_LIST_VARS_BATCH % {
+        'delimiter': delimiter,
+        'list_vars': BASH_LIST_VARS % {'module': '${module}'}}
+    proc = subprocess.Popen(['/bin/bash', '-c', script, 'foo'] + fnames,
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    rv = {}
+    lines = []
+    for line in output.split('\n'):
+        if not line.startswith(delimiter + ' '):
+            lines.append(line)
+            continue
+        pieces = line.split(' ')
+        if pieces[1] == 'begin':
+            lines = []
+        elif pieces[1] == 'end' and pieces[3] == '0':
+            try:
+                rv[fnames[int(pieces[2])]] = _parse_var_list('\n'.join(lines))
+            except ValueError:  # unbalanced quotes
+                pass
+    return rv
+
+
+def load_metadata(modules, workers=None):
+    # fills the metadata of the given modules. modules that aren't cached
+    # and can't be parsed statically are sourced in batches, spread over a
+    # bounded pool of bash processes. modules that fail to source are left
+    # alone, to fail again when their metadata is requested.
+    pending = {}
+    for module in modules:
+        if module.get_metadata(source=False) is None:
+            pending[module.fname] = module
+    if not pending:
+        return
+    if workers is None:
+        try:
+            workers = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (ValueError, OSError):
+            workers = 1
+    fnames = sorted(pending.keys())
+    size = max(BATCH_MIN_SIZE, -(-len(fnames) // max(workers, 1)))
+    chunks = [fnames[i:i + size] for i in range(0, len(fnames), size)]
+    results = [None] * len(chunks)
+
+    def worker(i):
+        with profiler.phase('source metadata batch %d (%d modules)' %
+                            (i, len(chunks[i]))):
+            results[i] = source_metadata_batch(chunks[i])
+
+    threads = []
+    for i in range(1, len(chunks)):
+        thread = threading.Thread(target=worker, args=(i,))
+        thread.start()
+        threads.append(thread)
+    worker(0)
+    for thread in threads:
+        thread.join()
+    for result in results:
+        for fname, metadata in result.iteritems():
+            pending[fname].set_metadata(metadata)
+
+
+class Module(object):
+
+    def __init__(self, fname, cache=None):
+        self.fname = fname
+        self.name = os.path.basename(self.fname)
+        self.cache = cache
+        self._metadata = None
+        self._key = None
+
+    def get_metadata(self, source=True):
+        # with source=False, returns None instead of sourcing a module whose
+        # metadata can't be parsed statically.
+        if self._metadata is not None:
+            return self._metadata
+        if self.cache is not None:
+            self._key = self.cache.stat(self.fname)
+            self._metadata = self.cache.get(self.fname, self._key)
+            if self._metadata is not None:
+                return self._metadata
+        with profiler.phase('parse metadata %s' % self.name):
+            metadata = self.parse_metadata()
+        if metadata is None:
+            if not source:
+                return None
+            with profiler.phase('source metadata %s' % self.name):
+                metadata = self.source_metadata()
+        self.set_metadata(metadata)
+        return metadata
+
+    def set_metadata(self, metadata):
+        self._metadata = metadata
+        if self.cache is not None:
+            self.cache.set(self.fname, self._key, metadata)
+
+    def parse_metadata(self):
+        raise NotImplementedError
+
+    def source_metadata(self):
+        raise NotImplementedError
+
     def build_argparse(self, subparser):
         metadata = self.get_metadata()
         parser = subparser.add_parser(self.name, help=metadata.get('help'))
         for arg in shlex.split(metadata.get('usage', '')):
-            rv = re_parse_args.match(arg)
+            rv = get_re_parse_args().match(arg)
             if rv is None:
                 raise RuntimeError('Inconsistent argument: %s' % arg)
             args = rv.groupdict()
             optional = args['lopt'] == '[' and args['ropt'] == ']'
             if args['argument'] is not None:
-                help = metadata.get('help_%s' % args['argument'].lower())
+                help = metadata.get('help_%s' %
+                                    args['argument'].lower().replace('-', '_'))
                 parser.add_argument(args['argument'], help=help,
                                     nargs=optional and '?' or 1)
             elif args['key'] is not None:
-                help = metadata.get('help_%s' % args['key_name'].lower())
+                help = metadata.get('help_%s' %
+                                    args['key_name'].lower().replace('-', '_'))
                 if args['value'] is not None:
                     parser.add_argument(args['key'], metavar=args['value'],
                                         required=not optional, help=help)
@@ -108,36 +994,631 @@ class BashModule(object):
         parser.set_defaults(_module=self)
         return parser
 
-    def run(self, args):
-        env = {'PATH': os.environ['PATH']}
+    def run(self, args, replace=False):
+        raise NotImplementedError
+
+
+class BashModule(Module):
+
+    def __init__(self, fname, cache=None, compile_dir=None):
+        Module.__init__(self, fname, cache)
+        self.compile_dir = compile_dir
+
+    def parse_metadata(self):
+        return parse_metadata(self.fname)
+
+    def source_metadata(self):
+        import subprocess
+        script = BASH_LIST_VARS % {'module': self.fname}
+        rv = subprocess.check_output(['/bin/bash', '-c', script])
+        return _parse_var_list(rv)
+
+    def build_env(self, args, environ=None):
+        if environ is None:
+            environ = os.environ
+        env = {'PATH': environ['PATH']}
         # locale vars
-        for var_name in os.environ:
+        for var_name in environ:
             if var_name.startswith('LC_') or var_name in ['LANG', 'LANGUAGE']:
-                env[var_name] = os.environ[var_name]
+                env[var_name] = environ[var_name]
+        # modules may keep their own files here. not created by foo.
+        env['FOO_MODULE_CACHE_DIR'] = os.path.join(get_cache_dir(), 'modules',
+                                                   self.name)
         for key, value in args.iteritems():
             if isinstance(value, list):
                 value = value[0]
             if value is None:
                 value = ''
             env['FOO_ARG_%s' % key.upper()] = value
-        script = ''
-        for levelno, levelname in logging._levelNames.iteritems():
-            if not isinstance(levelname, basestring):
+        return env
+
+    def build_script(self):
+        return bash_logging(self.name) + bash_foo() + BASH_RUN_MODULE % {
+            'module': self.fname}
+
+    def compile(self):
+        # returns the launcher of the module, building it if needed. its
+        # file name carries a hash of the module path, mtime, size and
+        # inode, the prelude and the foo version. stale launchers are kept,
+        # as a running job may be about to execute them; foo compile prunes
+        # them.
+        import hashlib
+        prelude = compile_prelude(self.compile_dir)
+        st = os.stat(self.fname)
+        key = hashlib.sha1(repr([__version__, prelude, self.fname,
+                                 st.st_mtime, st.st_size, st.st_ino]))
+        launcher = '%s-%s' % (key.hexdigest()[:16], self.name)
+        fname = os.path.join(self.compile_dir, launcher)
+        if not os.path.isfile(fname):
+            write_file(fname, BASH_LAUNCHER % {'version': __version__,
+                                               'module': self.fname,
+                                               'modulename': self.name,
+                                               'prelude': prelude}, 0755)
+        return fname
+
+    def build_command(self):
+        if self.compile_dir is not None:
+            try:
+                return ['/bin/bash', self.compile()]
+            except (IOError, OSError), e:
+                log.warning('Failed to compile %s: %s' % (self.name, e))
+        return ['/bin/bash', '-c', self.build_script()]
+
+    def start(self, args, stdin=None, stdout=None, stderr=None):
+        # starts the module without waiting for it, and returns its Popen
+        # object. SIGPIPE is restored, as python ignores it, so that the
+        # module dies when the reader of its output goes away.
+        import subprocess
+        return subprocess.Popen(self.build_command(),
+                                env=self.build_env(args), stdin=stdin,
+                                stdout=stdout, stderr=stderr,
+                                preexec_fn=lambda: signal.signal(
+                                    signal.SIGPIPE, signal.SIG_DFL))
+
+    def run(self, args, replace=False, stdout=None, stderr=None):
+        # with replace=True the current process is replaced by bash, and
+        # this method never returns. stdout and stderr are passed to Popen
+        # otherwise.
+        import subprocess
+        env = self.build_env(args)
+        cmd = self.build_command()
+        if replace:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execve(cmd[0], cmd, env)
+        proc = subprocess.Popen(cmd, env=env, stdout=stdout, stderr=stderr)
+        return proc.wait()
+
+
+class PythonModule(Module):
+
+    # python modules run inside the foo process. they declare FOO_*
+    # variables at module level, like bash modules, and a main() function
+    # that gets a dict with the parsed arguments and returns the exit status.
+    # they can log with logging.getLogger('foo.<module name>').
+
+    def __init__(self, fname, cache=None):
+        Module.__init__(self, fname, cache)
+        if self.name.endswith('.py'):
+            self.name = self.name[:-3]
+        self._namespace = None
+
+    def get_metadata(self, source=True):
+        # sourcing a python module doesn't spawn any process
+        return Module.get_metadata(self)
+
+    def load(self):
+        if self._namespace is None:
+            with open(self.fname) as fp:
+                code = compile(fp.read(), self.fname, 'exec')
+            namespace = {'__name__': 'foo_module_%s' % self.name,
+                         '__file__': self.fname}
+            exec code in namespace
+            self._namespace = namespace
+        return self._namespace
+
+    def parse_metadata(self):
+        # evaluates the literal FOO_* assignments at module level, without
+        # running the module. returns None if FOO_ variables are assigned in
+        # any other way.
+        import ast
+        try:
+            with open(self.fname) as fp:
+                tree = ast.parse(fp.read(), self.fname)
+        except (IOError, SyntaxError):
+            return None
+        stores = 0
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id.startswith('FOO_') \
+                    and not isinstance(node.ctx, ast.Load):
+                stores += 1
+        metadata = {}
+        for node in tree.body:
+            if not isinstance(node, ast.Assign):
                 continue
-            if levelname == 'NOTSET':
+            names = [i.id for i in node.targets if isinstance(i, ast.Name)
+                     and i.id.startswith('FOO_')]
+            if not names:
                 continue
-            script += BASH_LOGGING % {'levelname': levelname,
-                                      'levelname_lower': levelname.lower(),
-                                      'levelno': levelno, 'name': 'foo',
-                                      'modulename': self.name}
-        script += BASH_RUN_MODULE % {'module': self.fname}
-        proc = subprocess.Popen(['/bin/bash', '-c', script], env=env)
-        return proc.wait()
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+            if not isinstance(value, basestring):
+                return None
+            for name in names:
+                metadata[name.lower()[4:]] = value
+                stores -= 1
+        if stores != 0:
+            return None
+        return metadata
+
+    def source_metadata(self):
+        metadata = {}
+        for name, value in self.load().iteritems():
+            if name.startswith('FOO_') and isinstance(value, basestring):
+                metadata[name.lower()[4:]] = value
+        return metadata
+
+    def run(self, args, replace=False):
+        main = self.load().get('main')
+        if main is None:
+            raise RuntimeError('Module has no main function: %s' %
+                               self.fname)
+        return main(dict(args)) or 0
+
+
+class CompileCommand(object):
+
+    name = 'compile'
+    help = 'pre-build the launchers of all modules.'
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def build_argparse(self, subparser):
+        parser = subparser.add_parser(self.name, help=self.help)
+        parser.set_defaults(_module=self)
+        return parser
+
+    def run(self, args, replace=False):
+        rv = 0
+        compile_dir = None
+        launchers = set()
+        modules = self.runner.modules()
+        for name in sorted(modules.keys()):
+            if not isinstance(modules[name], BashModule):
+                continue
+            compile_dir = modules[name].compile_dir
+            try:
+                launcher = modules[name].compile()
+            except (IOError, OSError), e:
+                log.error('Failed to compile %s: %s' % (name, e))
+                rv = 1
+                continue
+            log.info('Compiled %s: %s' % (name, launcher))
+            launchers.add(os.path.basename(launcher))
+        if compile_dir is not None and rv == 0:
+            launchers.add(os.path.basename(compile_prelude(compile_dir)))
+            for i in os.listdir(compile_dir):
+                if i not in launchers:
+                    os.unlink(os.path.join(compile_dir, i))
+        return rv
+
+
+def parse_args(parser, argv):
+    # returns the parsed arguments, or the output and exit status of
+    # argparse, for --help, --version or invalid arguments. sys.stdout and
+    # sys.stderr are replaced while parsing, so callers running threads that
+    # write to them must hold a lock.
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        return parser.parse_args(argv), None
+    except SystemExit, e:
+        return None, (sys.stdout.getvalue(), sys.stderr.getvalue(),
+                      e.code or 0)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+class BatchCommand(object):
+
+    name = 'batch'
+    help = 'run many module invocations, one per line of the input, ' \
+        'discovering the modules and building the parser only once.'
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.lock = threading.Lock()
+
+    def build_argparse(self, subparser):
+        parser = subparser.add_parser(self.name, help=self.help)
+        parser.add_argument('--input', metavar='FILE',
+                            help='file with the invocations, like foo '
+                            'arguments, one per line (default: stdin).')
+        parser.add_argument('--jobs', type=int, default=4,
+                            help='invocations run at once (default: 4).')
+        parser.add_argument('--output-dir', metavar='DIR',
+                            help='write the output and exit status of each '
+                            'invocation to DIR/<number>.{out,err,status}, '
+                            'instead of printing the output prefixed by '
+                            '"[<number>] " as each one finishes.')
+        parser.set_defaults(_module=self)
+        return parser
+
+    def jobs(self, runner, args):
+        # yields (number, module, args, output) for each line of the input.
+        # output is (stdout, stderr, status) for invocations that can't run.
+        fp = args['input'] not in ('', '-') and open(args['input']) or \
+            sys.stdin
+        try:
+            number = 0
+            for line in fp:
+                try:
+                    argv = shlex.split(line, comments=True)
+                except ValueError, e:
+                    # unbalanced quotes fail only their own invocation
+                    number += 1
+                    yield number, None, None, (
+                        '', '%s: error: %s\n' % (runner.parser.prog, e), 2)
+                    continue
+                if not argv:
+                    continue
+                number += 1
+                if '--traceback' in argv:
+                    argv.pop(argv.index('--traceback'))
+                with self.lock:
+                    raw_args, output = parse_args(runner.parser, argv)
+                if output is not None:
+                    yield number, None, None, output
+                elif not isinstance(raw_args._module, BashModule):
+                    yield number, None, None, (
+                        '', 'only bash modules can run in batch: %s\n' %
+                        raw_args._module.name, 1)
+                else:
+                    yield number, raw_args._module, \
+                        runner.build_args(raw_args), None
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+
+    def run_job(self, number, module, args, output, output_dir):
+        import tempfile
+        if output is None:
+            stdout, stderr = tempfile.TemporaryFile(), \
+                tempfile.TemporaryFile()
+            try:
+                fds = self.runner.acquire_slots(module)
+                try:
+                    status = module.run(args, stdout=stdout, stderr=stderr)
+                finally:
+                    self.runner.release_slots(fds)
+                stdout.seek(0)
+                stderr.seek(0)
+                output = stdout.read(), stderr.read(), status
+            finally:
+                stdout.close()
+                stderr.close()
+        if output_dir:
+            prefix = os.path.join(output_dir, str(number))
+            for ext, content in zip(['out', 'err', 'status'],
+                                    output[:2] + ('%d\n' % output[2],)):
+                with open('%s.%s' % (prefix, ext), 'w') as fp:
+                    fp.write(content)
+            return output[2]
+        with self.lock:
+            for content, fp in zip(output[:2], [sys.stdout, sys.stderr]):
+                for line in content.splitlines():
+                    fp.write('[%d] %s\n' % (number, line))
+                fp.flush()
+        return output[2]
+
+    def worker(self, queue, statuses, output_dir):
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            try:
+                status = self.run_job(*(job + (output_dir,)))
+            except Exception, e:
+                log.error('Job %d failed: %s' % (job[0], e))
+                status = 1
+            statuses[job[0]] = status
+
+    def run(self, args, replace=False):
+        import Queue
+        if args['jobs'] < 1:
+            raise RuntimeError('Invalid number of jobs: %d' % args['jobs'])
+        if args['output_dir'] and not os.path.isdir(args['output_dir']):
+            os.makedirs(args['output_dir'])
+        runner = Runner()
+        runner.setup([])
+        queue = Queue.Queue(args['jobs'] * 2)
+        statuses = {}
+        threads = []
+        for i in range(args['jobs']):
+            thread = threading.Thread(target=self.worker,
+                                      args=(queue, statuses,
+                                            args['output_dir']))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for job in self.jobs(runner, args):
+                queue.put(job)
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        failed = sorted([i for i, j in statuses.iteritems() if j != 0])
+        for number in failed:
+            log.error('Job %d exited with status %d' % (number,
+                                                        statuses[number]))
+        log.info('%d jobs, %d failed' % (len(statuses), len(failed)))
+        return failed and 1 or 0
+
+
+class PipeCommand(object):
+
+    name = 'pipe'
+    help = 'run modules connected by pipes, each one reading the output ' \
+        'of the previous one. the invocations are separated by "::", like ' \
+        '"foo pipe dns example.com :: checker --strict".'
+    separator = '::'
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def build_argparse(self, subparser):
+        import argparse
+
+        class QuotedArgs(argparse.Action):
+            # module arguments can't be lists
+            def __call__(self, parser, namespace, values, option_string=None):
+                import pipes
+                setattr(namespace, self.dest,
+                        ' '.join([pipes.quote(i) for i in values]))
+
+        parser = subparser.add_parser(self.name, help=self.help)
+        parser.add_argument('--status-file', metavar='FILE',
+                            help='write the exit status of each module to '
+                            'FILE, as a JSON list.')
+        parser.add_argument('stages', nargs=argparse.REMAINDER,
+                            action=QuotedArgs, metavar='invocation',
+                            help='module and arguments, like foo '
+                            'arguments.')
+        parser.set_defaults(_module=self)
+        return parser
+
+    def stages(self, args):
+        stages = [[]]
+        for arg in shlex.split(args['stages']):
+            if arg == self.separator:
+                stages.append([])
+            else:
+                stages[-1].append(arg)
+        if [] in stages:
+            raise RuntimeError('Empty invocation in pipe: %s' %
+                               args['stages'])
+        return stages
+
+    def slot_limits(self, modules):
+        # the limits of all the modules, each one acquired once. the order
+        # is the one of single runs, module groups before the global one.
+        limits = {}
+        for module in modules:
+            limits.update(self.runner.slot_limits(module))
+        return sorted(limits.items(), key=lambda i: (i[0] == 'global', i[0]))
+
+    def run(self, args, replace=False):
+        import json
+        import subprocess
+        stages = self.stages(args)
+        # discovery and metadata are shared by all the invocations
+        runner = Runner()
+        runner.setup([], [runner.find_module_name(i) for i in stages])
+        modules = []
+        for argv in stages:
+            raw_args, output = parse_args(runner.parser, argv)
+            if output is not None:
+                sys.stdout.write(output[0])
+                sys.stderr.write(output[1])
+                return output[2]
+            if not isinstance(raw_args._module, BashModule):
+                raise RuntimeError('Only bash modules can run in a pipe: %s'
+                                   % raw_args._module.name)
+            modules.append((raw_args._module, runner.build_args(raw_args)))
+        fds = self.runner.acquire_limits(
+            self.slot_limits([i for i, j in modules]))
+        procs = []
+        stdin = None
+        try:
+            sys.stdout.flush()
+            for i, (module, module_args) in enumerate(modules):
+                last = i == len(modules) - 1
+                proc = module.start(module_args, stdin=stdin,
+                                    stdout=not last and subprocess.PIPE or
+                                    None)
+                if stdin is not None:
+                    # the reader of a pipe must be its only holder
+                    stdin.close()
+                stdin = proc.stdout
+                procs.append(proc)
+            statuses = [proc.wait() for proc in procs]
+        finally:
+            if stdin is not None:
+                stdin.close()
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+                    proc.wait()
+            self.runner.release_slots(fds)
+        results = []
+        for i, (module, module_args) in enumerate(modules):
+            # modules killed by a signal get the status the shell gives them
+            status = statuses[i] < 0 and 128 - statuses[i] or statuses[i]
+            results.append({'stage': i + 1, 'module': module.name,
+                            'status': status})
+            message = 'Stage %d (%s) exited with status %d' % (
+                i + 1, module.name, status)
+            if status == 0:
+                log.info(message)
+            else:
+                log.error(message)
+        if args['status_file']:
+            with open(args['status_file'], 'w') as fp:
+                json.dump(results, fp)
+        # like bash with pipefail, the status of the last stage that failed
+        failed = [i['status'] for i in results if i['status'] != 0]
+        return failed and failed[-1] or 0
+
+
+class SlotsCommand(object):
+
+    name = 'slots'
+    help = 'show the concurrency limits set with FOO_MAX_CONCURRENCY, and ' \
+        'the number of running and queued modules of each one.'
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def build_argparse(self, subparser):
+        parser = subparser.add_parser(self.name, help=self.help)
+        parser.add_argument('--json', action='store_const', const='1',
+                            help='print a JSON object for each limit.')
+        parser.set_defaults(_module=self)
+        return parser
+
+    def run(self, args, replace=False):
+        import json
+        slots = Slots(os.path.join(get_cache_dir(), 'slots'))
+        for group in slots.status():
+            if args['json']:
+                print json.dumps(group, sort_keys=True)
+            else:
+                print '%-30s %d/%d running, %d queued' % (
+                    group['group'], group['running'], group['limit'],
+                    group['queued'])
+        sys.stdout.flush()
+        return 0
+
+
+_sysconfig_base = None
+
+
+def sysconfig_base():
+    # sysconfig builds all of its variables on first use. the base can't
+    # change, and the server and batch set up a runner many times.
+    global _sysconfig_base
+    if _sysconfig_base is None:
+        _sysconfig_base = sysconfig.get_config_var('base')
+    return _sysconfig_base
+
+
+def search_paths():
+    # The code below can't use any log level lower than WARNING
+    paths = []
+    _user = os.path.join(os.path.expanduser('~'), '.local', 'libexec',
+                         'foo-tools')
+    if os.path.isdir(_user):
+        paths.append(_user)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    _local = os.path.join(cwd, 'modules')
+    if os.path.isdir(_local):
+        paths.append(_local)
+    _egg = os.path.join(cwd, 'libexec', 'foo-tools')
+    if os.path.isdir(_egg):
+        paths.append(_egg)
+    _global = os.path.join(sysconfig_base(), 'libexec', 'foo-tools')
+    if os.path.isdir(_global):
+        paths.append(_global)
+    return paths
+
+
+def log_levels():
+    return [j for i, j in logging._levelNames.iteritems()
+            if isinstance(j, basestring)]
+
+
+def complete(line):
+    # returns the completions for a partial command line, using only the
+    # module index and cached or statically parsed metadata.
+    try:
+        words = shlex.split(line)
+    except ValueError:  # unbalanced quotes
+        return []
+    if not line or line[-1].isspace():
+        words.append('')
+    words, current = words[1:-1], words[-1]
+    if current.startswith('--') and '=' in current:
+        option, current = current.split('=', 1)
+        words.append(option)
+    i = Runner.find_module(words)
+    if i is None:
+        if words and words[-1] == '--log-level':
+            candidates = log_levels()
+        elif current.startswith('-'):
+            candidates = Runner.options
+        else:
+            index = ModuleIndex(os.path.join(get_cache_dir(), 'modules.json'))
+            candidates = index.resolve(search_paths()).keys()
+            candidates += [j.name for j in Runner.commands]
+            index.save()
+    else:
+        index = ModuleIndex(os.path.join(get_cache_dir(), 'modules.json'))
+        module = index.resolve(search_paths()).get(words[i])
+        if module is None:
+            return []
+        fname, kind = module
+        cache = MetadataCache(os.path.join(get_cache_dir(), 'metadata.json'))
+        metadata = cache.get(fname, cache.stat(fname))
+        if metadata is None:
+            if kind == 'python':
+                metadata = PythonModule(fname).parse_metadata()
+            else:
+                metadata = parse_metadata(fname)
+        if metadata is None:
+            metadata = {}
+        candidates = ['-h', '--help']
+        used = [j.split('=', 1)[0] for j in words[i + 1:]]
+        for arg in shlex.split(metadata.get('usage', '')):
+            rv = get_re_parse_args().match(arg)
+            if rv is None or rv.group('key') is None:
+                continue
+            if rv.group('value') is not None:
+                if words[-1] == rv.group('key'):
+                    return []
+                candidates.append(rv.group('key') + '=')
+            else:
+                candidates.append(rv.group('key'))
+        candidates = [j for j in candidates if j.rstrip('=') not in used]
+    return sorted([j for j in candidates if j.startswith(current)])
 
 
 class Runner(object):
 
+    # built-in commands, that take precedence over modules
+    commands = [BatchCommand, CompileCommand, PipeCommand, SlotsCommand]
+
+    # global options that consume the following argument
+    value_options = ['--log-level', '--queue-timeout', '--socket']
+
+    # global options that consume the following argument only if it is one
+    # of their choices
+    optional_value_options = {'--profile': ['text', 'json']}
+
+    # global options offered by shell completion
+    options = ['-h', '--help', '--version', '--traceback', '--log-level=',
+               '--rebuild-cache', '--no-cache', '--queue-timeout=',
+               '--profile', '--server', '--client', '--socket=']
+
     def __init__(self):
+        import argparse
+        self.cache = None
+        self.rebuild_cache = False
+        self.queue_timeout = None
         self.parser = argparse.ArgumentParser(
             description=__description__)
         self.subparser = self.parser.add_subparsers(title='modules')
@@ -147,52 +1628,134 @@ class Runner(object):
                                  action='store_true',
                                  help='print Python traceback in errors, '
                                  'if possible.')
-        levels = [j for i, j in logging._levelNames.iteritems()
-                  if isinstance(j, basestring)]
         self.parser.add_argument('--log-level', dest='log_level',
-                                 default='WARNING', choices=levels,
+                                 default='WARNING', choices=log_levels(),
                                  help='configure logging level.')
+        self.parser.add_argument('--rebuild-cache', dest='_rebuild_cache',
+                                 action='store_true',
+                                 help='discard cached modules and metadata '
+                                 'and look them up again.')
+        self.parser.add_argument('--no-cache', dest='_no_cache',
+                                 action='store_true',
+                                 help='run modules even if they have a '
+                                 'fresh cached result.')
+        self.parser.add_argument('--queue-timeout', dest='_queue_timeout',
+                                 type=float, metavar='SECONDS',
+                                 help='give up after waiting SECONDS for a '
+                                 'free slot of the concurrency limits of the '
+                                 'module. defaults to $FOO_QUEUE_TIMEOUT, or '
+                                 'waiting forever.')
+        self.parser.add_argument('--profile', dest='_profile', nargs='?',
+                                 const='text',
+                                 choices=self.optional_value_options[
+                                     '--profile'],
+                                 metavar='FORMAT',
+                                 help='print the time spent in each phase '
+                                 'and the resource usage of the module to '
+                                 'stderr, as text or json. also enabled by '
+                                 'setting $FOO_PROFILE to 1, text or json.')
+        self.parser.add_argument('--server', dest='_server',
+                                 action='store_true',
+                                 help='serve commands from clients over a '
+                                 'unix socket.')
+        self.parser.add_argument('--client', dest='_client',
+                                 action='store_true',
+                                 help='run the command on the server, if '
+                                 'available. also enabled by setting '
+                                 '$FOO_CLIENT.')
+        self.parser.add_argument('--socket', dest='_socket', metavar='PATH',
+                                 help='unix socket of the server. defaults '
+                                 'to $FOO_SOCKET.')
 
     def search_paths(self):
-        # The code below can't use any log level lower than WARNING
-        paths = []
-        _user = os.path.join(os.path.expanduser('~'), '.local', 'libexec',
-                             'foo-tools')
-        if os.path.isdir(_user):
-            paths.append(_user)
-        cwd = os.path.dirname(os.path.abspath(__file__))
-        _local = os.path.join(cwd, 'modules')
-        if os.path.isdir(_local):
-            paths.append(_local)
-        _egg = os.path.join(cwd, 'libexec', 'foo-tools')
-        if os.path.isdir(_egg):
-            paths.append(_egg)
-        _global = os.path.join(sysconfig.get_config_var('base'), 'libexec',
-                               'foo-tools')
-        if os.path.isdir(_global):
-            paths.append(_global)
-        return paths
+        return search_paths()
 
     def modules(self):
         # The code below can't use any log level lower than WARNING
+        index = ModuleIndex(os.path.join(get_cache_dir(), 'modules.json'),
+                            rebuild=self.rebuild_cache)
         modules = {}
-        for path in self.search_paths()[::-1]:
-            for module in os.listdir(path):
-                module_file = os.path.join(path, module)
-                if os.path.isfile(module_file):
-                    modules[module] = BashModule(module_file)
+        for name, (fname, kind) in \
+                index.resolve(self.search_paths()).iteritems():
+            if kind == 'python':
+                modules[name] = PythonModule(fname, self.cache)
+            else:
+                modules[name] = BashModule(
+                    fname, self.cache,
+                    os.path.join(get_cache_dir(), 'compiled'))
+        index.save()
         return modules
 
-    def run(self):
-        modules = self.modules()
-        for name in sorted(modules.keys()):
-            modules[name].build_argparse(self.subparser)
-        argv = sys.argv[1:]
-        # ugly hack to avoid stupid argument ordering
-        if '--traceback' in argv:
-            argv.pop(argv.index('--traceback'))
-        raw_args = self.parser.parse_args(argv)
-        log.setLevel(logging._levelNames[raw_args.log_level])
+    @classmethod
+    def find_module(cls, argv):
+        # returns the position of the name of the module being invoked in
+        # argv, or None if the full parser is needed (--help, or no module
+        # name given).
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            if arg in ['-h', '--help']:
+                return None
+            if arg == '--':
+                return i + 1 < len(argv) and i + 1 or None
+            if not arg.startswith('-'):
+                return i
+            if '=' not in arg:
+                for option in cls.value_options:
+                    if len(arg) > 2 and option.startswith(arg):
+                        i += 1
+                        break
+                if argv[i + 1:i + 2] and argv[i + 1] in \
+                        cls.optional_value_options.get(arg, []):
+                    i += 1
+            i += 1
+        return None
+
+    def find_module_name(self, argv):
+        i = self.find_module(argv)
+        if i is not None:
+            return argv[i]
+
+    def setup(self, argv, names=None):
+        # discovers the modules and builds the parser needed to parse argv,
+        # or invocations of any of the given module names. an empty argv
+        # builds the full parser.
+        self.rebuild_cache = '--rebuild-cache' in argv
+        with profiler.phase('load metadata cache'):
+            self.cache = MetadataCache(
+                os.path.join(get_cache_dir(), 'metadata.json'),
+                rebuild=self.rebuild_cache)
+        with profiler.phase('find modules'):
+            modules = self.modules()
+        commands = {}
+        for command_class in self.commands:
+            command = command_class(self)
+            if command.name in modules:
+                log.warning('Module %s is shadowed by a built-in command' %
+                            modules[command.name].fname)
+            commands[command.name] = command
+        if names is None:
+            names = [self.find_module_name(argv)]
+        if all([i in commands or i in modules for i in names]):
+            for name in sorted(set(names)):
+                with profiler.phase('build parser %s' % name):
+                    if name in commands:
+                        commands[name].build_argparse(self.subparser)
+                    else:
+                        modules[name].build_argparse(self.subparser)
+        else:
+            with profiler.phase('load metadata'):
+                load_metadata(modules.values())
+            parsers = modules.copy()
+            parsers.update(commands)
+            with profiler.phase('build parsers'):
+                for name in sorted(parsers.keys()):
+                    parsers[name].build_argparse(self.subparser)
+        with profiler.phase('save metadata cache'):
+            self.cache.prune([module.fname for module in modules.values()])
+            self.cache.save()
+
+    def build_args(self, raw_args):
         args = {}
         for arg in raw_args.__dict__:
             if arg.startswith('_'):  # private args
@@ -205,13 +1768,553 @@ class Runner(object):
             args[arg] = value
         if 'log_level' in args:
             args['log_level'] = str(logging._levelNames[args['log_level']])
+        return args
+
+    def run(self):
+        argv = sys.argv[1:]
+        # ugly hack to avoid stupid argument ordering
+        if '--traceback' in argv:
+            argv.pop(argv.index('--traceback'))
+        fmt = self.profile_format(argv)
+        if fmt is None:
+            return self.run_module(argv)
+        profiler.enable()
+        try:
+            return self.run_module(argv)
+        except SystemExit:
+            # --help and usage errors exit before running the module, with
+            # nothing worth reporting
+            fmt = None
+            raise
+        finally:
+            profiler.disable()
+            if fmt is not None:
+                print >> sys.stderr, profiler.format(fmt)
+
+    def profile_format(self, argv):
+        # removes --profile and its format from the global options in argv,
+        # so that the option doesn't swallow the name of the module. returns
+        # the output format of the profile, or None if not profiling.
+        value = os.environ.get('FOO_PROFILE', '')
+        fmt = {'1': 'text', 'text': 'text',
+               'json': 'json'}.get(value.lower())
+        if fmt is None and value.lower() not in ('', '0', 'false', 'no'):
+            log.warning('Invalid $FOO_PROFILE: %s' % value)
+        formats = self.optional_value_options['--profile']
+        end = self.find_module(argv)
+        if end is None:
+            end = len(argv)
+        options = []
+        i = 0
+        while i < end:
+            arg = argv[i]
+            i += 1
+            if arg == '--profile':
+                fmt = 'text'
+                if i < end and argv[i] in formats:
+                    fmt = argv[i]
+                    i += 1
+            elif arg.startswith('--profile='):
+                fmt = arg[len('--profile='):]
+                if fmt not in formats:
+                    self.parser.error('argument --profile: invalid choice: '
+                                      '%r (choose from %s)' %
+                                      (fmt, ', '.join(formats)))
+            else:
+                options.append(arg)
+        argv[:end] = options
+        return fmt
+
+    def run_module(self, argv):
+        with profiler.phase('setup'):
+            self.setup(argv)
+        with profiler.phase('parse arguments'):
+            raw_args = self.parser.parse_args(argv)
+        log.setLevel(logging._levelNames[raw_args.log_level])
+        args = self.build_args(raw_args)
         log.debug('Calling %s with arguments: %s' % (raw_args._module.name,
                                                      args))
-        return raw_args._module.run(args)
+        module = raw_args._module
+        self.queue_timeout = raw_args._queue_timeout
+        if self.queue_timeout is None:
+            self.queue_timeout = self.parse_env_number('FOO_QUEUE_TIMEOUT',
+                                                       float)
+        if not profiler.enabled:
+            return self.dispatch(module, args, raw_args, replace=True)
+        # the module runs as a child, so that its resource usage is known
+        before = profiler.children_usage()
+        try:
+            with profiler.phase('run %s' % module.name):
+                return self.dispatch(module, args, raw_args)
+        finally:
+            profiler.set_children(before)
+
+    def dispatch(self, module, args, raw_args, replace=False):
+        if isinstance(module, BashModule):
+            ttl = module.get_metadata().get('cache_ttl')
+            if ttl:
+                try:
+                    ttl = float(ttl)
+                except ValueError:
+                    log.warning('Invalid FOO_CACHE_TTL for %s: %s' %
+                                (module.name, ttl))
+                else:
+                    return self.run_cached(module, args, ttl,
+                                           raw_args._no_cache)
+        # with replace=True the slots are inherited by the module process
+        fds = self.acquire_slots(module, inherit=replace)
+        try:
+            return module.run(args, replace=replace)
+        finally:
+            self.release_slots(fds)
+
+    def parse_env_number(self, name, type_=int, environ=None):
+        value = (environ is None and os.environ or environ).get(name)
+        if not value:
+            return None
+        try:
+            return type_(value)
+        except ValueError:
+            log.warning('Invalid $%s: %s' % (name, value))
+
+    def slot_limits(self, module, environ=None):
+        # returns the (group, limit) concurrency limits of module: its own
+        # FOO_MAX_CONCURRENCY, and the global $FOO_MAX_CONCURRENCY of environ
+        # (default: os.environ).
+        if not isinstance(module, Module):
+            return []
+        limits = []
+        value = module.get_metadata().get('max_concurrency')
+        if value:
+            try:
+                limits.append(('modules/%s' % module.name, int(value)))
+            except ValueError:
+                log.warning('Invalid FOO_MAX_CONCURRENCY for %s: %s' %
+                            (module.name, value))
+        value = self.parse_env_number('FOO_MAX_CONCURRENCY', int, environ)
+        if value:
+            limits.append(('global', value))
+        return [(i, j) for i, j in limits if j > 0]
+
+    def acquire_slots(self, module, inherit=False):
+        # returns the descriptors holding the slots of module, to be passed
+        # to release_slots.
+        return self.acquire_limits(self.slot_limits(module), inherit)
+
+    def acquire_limits(self, limits, inherit=False):
+        if not limits:
+            return []
+        slots = Slots(os.path.join(get_cache_dir(), 'slots'))
+        return slots.acquire_all(limits, self.queue_timeout, inherit)
+
+    def release_slots(self, fds):
+        for fd in fds:
+            os.close(fd)
+
+    def run_cached(self, module, args, ttl, no_cache=False):
+        # replays the stdout and exit status of a previous run with the same
+        # module content and arguments, if not older than ttl seconds.
+        # otherwise the module runs, with its stdout copied to the cache.
+        cache = ResultCache(os.path.join(get_cache_dir(), 'results'))
+        key = cache.key(module, module.build_env(args))
+        result = not no_cache and cache.get(key, ttl) or None
+        if result is not None:
+            log.debug('Using cached result of %s' % module.name)
+            sys.stdout.write(result[1])
+            sys.stdout.flush()
+            return result[0]
+        chunks = []
+
+        def tee(fd):
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                chunks.append(data)
+                sys.stdout.write(data)
+                sys.stdout.flush()
+
+        fds = self.acquire_slots(module)
+        try:
+            rfd, wfd = os.pipe()
+            thread = threading.Thread(target=tee, args=(rfd,))
+            thread.start()
+            try:
+                status = module.run(args, stdout=wfd)
+            finally:
+                os.close(wfd)
+                thread.join()
+                os.close(rfd)
+        finally:
+            self.release_slots(fds)
+        cache.set(key, status, ''.join(chunks))
+        return status
+
+
+def get_socket_path(options):
+    # options are the global options of foo, without the module arguments
+    for i, arg in enumerate(options):
+        if arg.startswith('--socket='):
+            return arg[len('--socket='):]
+        if arg == '--socket' and i + 1 < len(options):
+            return options[i + 1]
+    socket_path = os.environ.get('FOO_SOCKET')
+    if socket_path:
+        return socket_path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'foo-tools.sock')
+    return os.path.join(get_cache_dir(), 'server.sock')
+
+
+# frames exchanged between client and server: a type byte and the payload
+# length, followed by the payload.
+#
+#   client -> server: A (json with argv, cwd and environment), I (stdin
+#                     data), i (stdin closed)
+#   server -> client: S (module started, stdin may be sent), O (stdout
+#                     data), E (stderr data), X (exit status), F (run the
+#                     command locally)
+FRAME_HEADER = struct.Struct('!cI')
+
+
+def send_frame(sock, frame_type, payload=''):
+    sock.sendall(FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(fp):
+    # returns (None, None) on EOF
+    header = fp.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None, None
+    frame_type, length = FRAME_HEADER.unpack(header)
+    payload = fp.read(length)
+    if len(payload) < length:
+        return None, None
+    return frame_type, payload
+
+
+class WorkerPool(object):
+
+    # pre-started bash processes, with the logging functions and die()
+    # already defined, waiting for a job on stdin. each worker runs a single
+    # job, with an empty environment besides what the job exports.
+
+    def __init__(self, size):
+        self.size = size
+        self.script = BASH_WORKER % {
+            'prelude': bash_logging('${FOO_MODULE_NAME}') + bash_foo() +
+            BASH_DIE}
+        self.workers = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.filler = None
+        self.fill()
+
+    def spawn(self):
+        import subprocess
+        return subprocess.Popen(['/bin/bash', '-c', self.script], env={},
+                                cwd='/', stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+
+    def fill(self):
+        while True:
+            with self.lock:
+                if self.closed or len(self.workers) >= self.size:
+                    return
+            worker = self.spawn()
+            with self.lock:
+                if not self.closed:
+                    self.workers.append(worker)
+                    continue
+            worker.kill()
+            worker.wait()
+            return
+
+    def get(self):
+        worker = None
+        with self.lock:
+            while self.workers and worker is None:
+                worker = self.workers.pop(0)
+                if worker.poll() is not None:
+                    worker = None
+        if worker is None:
+            worker = self.spawn()
+        self.filler = threading.Thread(target=self.fill)
+        self.filler.daemon = True
+        self.filler.start()
+        return worker
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.workers = self.workers, []
+        if self.filler is not None:
+            self.filler.join()
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+            worker.wait()
+
+
+class Server(object):
+
+    # keeps the discovered modules, their metadata and the full parser in
+    # memory, and runs bash modules on pre-started workers for thin clients
+    # connected to a unix socket. modules are discovered when the server
+    # starts. python modules, built-in commands and modules with cached
+    # results (FOO_CACHE_TTL) are run by the client.
+
+    def __init__(self, socket_path, workers=4):
+        self.socket_path = socket_path
+        self.runner = Runner()
+        self.runner.setup([])
+        self.pool = WorkerPool(workers)
+        self.parse_lock = threading.Lock()
+        self.sock = None
+
+    def parse_args(self, argv):
+        with self.parse_lock:
+            return parse_args(self.runner.parser, argv)
+
+    def build_job(self, module, args, request):
+        import pipes
+        env = module.build_env(args, request['environ'])
+        exports = ['%s=%s' % (key, pipes.quote(value))
+                   for key, value in sorted(env.iteritems())]
+        return BASH_WORKER_JOB % {'cwd': pipes.quote(request['cwd']),
+                                  'env': ' '.join(exports),
+                                  'modulename': pipes.quote(module.name),
+                                  'module': pipes.quote(module.fname)}
+
+    def acquire_slots(self, module, raw_args, environ):
+        # the slots of module, with the limits and queue timeout of the
+        # client instead of the ones the server was started with.
+        timeout = raw_args._queue_timeout
+        if timeout is None:
+            timeout = self.runner.parse_env_number('FOO_QUEUE_TIMEOUT',
+                                                   float, environ)
+        limits = self.runner.slot_limits(module, environ)
+        if not limits:
+            return []
+        slots = Slots(os.path.join(get_cache_dir(), 'slots'))
+        return slots.acquire_all(limits, timeout)
+
+    def handle(self, conn):
+        import json
+        import socket
+        try:
+            fp = conn.makefile('rb')
+            frame_type, payload = recv_frame(fp)
+            if frame_type != 'A':
+                return
+            request = json.loads(payload)
+            argv = [str(i) for i in request['argv']]
+            request['environ'] = dict(
+                (str(i), str(j)) for i, j in request['environ'].iteritems())
+            if '--traceback' in argv:
+                argv.pop(argv.index('--traceback'))
+            raw_args, output = self.parse_args(argv)
+            if output is not None:
+                send_frame(conn, 'O', output[0])
+                send_frame(conn, 'E', output[1])
+                send_frame(conn, 'X', str(output[2]))
+                return
+            module = raw_args._module
+            if not isinstance(module, BashModule) or \
+                    module.get_metadata().get('cache_ttl'):
+                send_frame(conn, 'F')
+                return
+            job = self.build_job(module, self.runner.build_args(raw_args),
+                                 request)
+            try:
+                fds = self.acquire_slots(module, raw_args,
+                                         request['environ'])
+            except RuntimeError, e:
+                send_frame(conn, 'E', '%s\n' % e)
+                send_frame(conn, 'X', '1')
+                return
+            try:
+                worker = self.pool.get()
+                worker.stdin.write(job + '\0')
+                worker.stdin.flush()
+                send_frame(conn, 'S')
+                thread = threading.Thread(target=self.forward_stdin,
+                                          args=(fp, worker))
+                thread.daemon = True
+                thread.start()
+                self.forward_output(conn, worker)
+                status = worker.wait()
+            finally:
+                self.runner.release_slots(fds)
+            send_frame(conn, 'X', str(status))
+        except (IOError, OSError, socket.error, ValueError, KeyError), e:
+            log.error('Failed to handle request: %s' % e)
+        finally:
+            conn.close()
+
+    def forward_stdin(self, fp, worker):
+        import socket
+        try:
+            while True:
+                frame_type, payload = recv_frame(fp)
+                if frame_type == 'I':
+                    worker.stdin.write(payload)
+                    worker.stdin.flush()
+                    continue
+                if frame_type is None and worker.poll() is None:
+                    worker.kill()  # client is gone
+                break
+        except (IOError, OSError, socket.error):
+            pass
+        try:
+            worker.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def forward_output(self, conn, worker):
+        fds = {worker.stdout.fileno(): 'O', worker.stderr.fileno(): 'E'}
+        while fds:
+            for fd in select.select(fds.keys(), [], [])[0]:
+                data = os.read(fd, 65536)
+                if data:
+                    send_frame(conn, fds[fd], data)
+                else:
+                    del fds[fd]
+
+    def serve_forever(self):
+        import socket
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(077)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(128)
+        log.info('Listening on %s' % self.socket_path)
+        try:
+            while True:
+                try:
+                    conn = self.sock.accept()[0]
+                except socket.error:
+                    if self.sock is None:
+                        break
+                    raise
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+        return 0
+
+    def close(self):
+        import socket
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+            except socket.error:
+                pass
+            sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.pool.close()
+
+
+def run_client(argv, socket_path, stdin=None, stdout=None, stderr=None):
+    # runs the command on the server. returns its exit status, or None if
+    # the server isn't available or asked for the command to be run
+    # locally.
+    import json
+    import socket
+    if stdin is None and not sys.stdin.isatty():
+        stdin = sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    try:
+        # the environment of the module, and the limits of its slots
+        environ = {}
+        for var_name in os.environ:
+            if var_name.startswith('LC_') or \
+                    var_name in ['PATH', 'LANG', 'LANGUAGE',
+                                 'FOO_MAX_CONCURRENCY', 'FOO_QUEUE_TIMEOUT']:
+                environ[var_name] = os.environ[var_name]
+        send_frame(sock, 'A', json.dumps({'argv': argv, 'cwd': os.getcwd(),
+                                          'environ': environ}))
+        fp = sock.makefile('rb')
+        while True:
+            frame_type, payload = recv_frame(fp)
+            if frame_type == 'S':
+                thread = threading.Thread(target=_forward_client_stdin,
+                                          args=(sock, stdin))
+                thread.daemon = True
+                thread.start()
+            elif frame_type == 'O':
+                stdout.write(payload)
+                stdout.flush()
+            elif frame_type == 'E':
+                stderr.write(payload)
+                stderr.flush()
+            elif frame_type == 'X':
+                return int(payload)
+            elif frame_type == 'F':
+                return None
+            else:
+                raise RuntimeError('Connection to server lost')
+    finally:
+        sock.close()
+
+
+def _forward_client_stdin(sock, stdin):
+    import socket
+    try:
+        if stdin is not None:
+            while True:
+                data = os.read(stdin.fileno(), 65536)
+                if not data:
+                    break
+                send_frame(sock, 'I', data)
+        send_frame(sock, 'i')
+    except (IOError, OSError, socket.error):
+        pass
 
 
 def main():
+    if sys.argv[1:] == ['--version']:
+        # the same output as argparse, without building the parser
+        print >> sys.stderr, '%s %s' % (os.path.basename(sys.argv[0]),
+                                        __version__)
+        return 0
+    if sys.argv[1:2] == ['--complete']:
+        try:
+            for candidate in complete(' '.join(sys.argv[2:])):
+                print candidate
+        except Exception:
+            return 1
+        return 0
+    argv = sys.argv[1:]
     try:
+        client = os.environ.get('FOO_CLIENT')
+        if client or '--server' in argv or '--client' in argv:
+            # only the global options before the module name are foo's
+            options = argv[:Runner.find_module(argv)]
+            if '--server' in options:
+                signal.signal(signal.SIGTERM,
+                              lambda signum, frame: sys.exit(0))
+                return Server(get_socket_path(options)).serve_forever()
+            if client or '--client' in options:
+                rv = run_client(argv, get_socket_path(options))
+                if rv is not None:
+                    return rv
         runner = Runner()
         return runner.run()
     except Exception, e:
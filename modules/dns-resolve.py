@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the python engine of the dns module: a resolver sending the queries of
+# many hosts at once over a single udp socket, printing the same reports of
+# the dns module. it is called by the dns module as `foo dns-resolve'.
+
+import json
+import logging
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+FOO_HELP = 'resolve hostnames with the python engine of the dns module.'
+FOO_USAGE = '[--input=file] [--json] [--nameservers=addresses] ' \
+    '[--timeout=seconds] [--retries=number] [--window=number] [--watch] ' \
+    '[--interval=seconds] [url_or_hostname]'
+FOO_HELP_URL_OR_HOSTNAME = 'URL or hostname.'
+FOO_HELP_INPUT = 'read URLs or hostnames from a file, one per line ("-" ' \
+    'for stdin).'
+FOO_HELP_JSON = 'print a JSON object for each host.'
+FOO_HELP_NAMESERVERS = 'comma-separated nameservers, with optional ports ' \
+    '(default: from /etc/resolv.conf).'
+FOO_HELP_TIMEOUT = 'seconds to wait for an answer before retrying ' \
+    '(default: 2).'
+FOO_HELP_RETRIES = 'times to retry unanswered queries (default: 2).'
+FOO_HELP_WINDOW = 'hosts resolved at once (default: 64).'
+FOO_HELP_WATCH = 'keep resolving the hostnames when their records expire, ' \
+    'printing what changed.'
+FOO_HELP_INTERVAL = 'resolve the hostnames every given number of seconds ' \
+    'in watch mode, instead of following the TTLs.'
+
+# seconds between queries in watch mode, for hostnames without records or
+# whose queries timed out, and the minimum for the other hostnames.
+DEFAULT_INTERVAL = 60
+MIN_INTERVAL = 1
+
+log = logging.getLogger('foo.dns-resolve')
+
+DNS_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15,
+             'AAAA': 28}
+DNS_TYPE_NAMES = dict((j, i) for i, j in DNS_TYPES.iteritems())
+DNS_HEADER = struct.Struct('!HHHHHH')
+DNS_RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN',
+              4: 'NOTIMP', 5: 'REFUSED'}
+
+
+class DNSError(Exception):
+    pass
+
+
+def dns_name(name):
+    # names are compared without case and without the trailing dot of
+    # fully qualified names.
+    return name.rstrip('.').lower()
+
+
+def dns_build_query(qid, name, qtype):
+    qname = ''
+    for label in name.rstrip('.').split('.'):
+        if not label or len(label) > 63:
+            raise DNSError('Invalid name: %s' % name)
+        qname += chr(len(label)) + label
+    if len(qname) > 254:
+        raise DNSError('Invalid name: %s' % name)
+    return DNS_HEADER.pack(qid, 0x0100, 1, 0, 0, 0) + qname + '\0' + \
+        struct.pack('!HH', DNS_TYPES[qtype], 1)
+
+
+def dns_read_name(data, offset):
+    # returns the name starting at offset, following compression pointers,
+    # and the offset right after it.
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 127:
+                raise DNSError('Invalid compression pointer')
+            offset = (length & 0x3f) << 8 | ord(data[offset + 1])
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length])
+        offset += length
+    return '.'.join(labels), end is None and offset or end
+
+
+def dns_parse_rdata(data, offset, rtype, rdlength):
+    rdata = data[offset:offset + rdlength]
+    if rtype == DNS_TYPES['A'] and rdlength == 4:
+        return socket.inet_ntoa(rdata)
+    if rtype == DNS_TYPES['AAAA'] and rdlength == 16:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype in (DNS_TYPES['NS'], DNS_TYPES['CNAME'], DNS_TYPES['PTR']):
+        return dns_read_name(data, offset)[0]
+    if rtype == DNS_TYPES['MX']:
+        return (struct.unpack_from('!H', data, offset)[0],
+                dns_read_name(data, offset + 2)[0])
+    if rtype == DNS_TYPES['SOA']:
+        mname, offset = dns_read_name(data, offset)
+        rname, offset = dns_read_name(data, offset)
+        return (mname, rname) + struct.unpack_from('!IIIII', data, offset)
+    return rdata
+
+
+def dns_parse_response(data):
+    # returns the id, question and rcode of a response, and the records of
+    # its answer and authority sections, as (name, ttl, type, data) tuples.
+    try:
+        qid, flags, qdcount, ancount, nscount, arcount = \
+            DNS_HEADER.unpack_from(data)
+        offset = DNS_HEADER.size
+        question = None
+        for i in range(qdcount):
+            name, offset = dns_read_name(data, offset)
+            question = (dns_name(name),
+                        struct.unpack_from('!H', data, offset)[0])
+            offset += 4
+        sections = ([], [])
+        for section, count in zip(sections, (ancount, nscount)):
+            for i in range(count):
+                name, offset = dns_read_name(data, offset)
+                rtype, rclass, ttl, rdlength = \
+                    struct.unpack_from('!HHIH', data, offset)
+                offset += 10
+                if offset + rdlength > len(data):
+                    raise DNSError('Truncated record')
+                section.append((name, ttl, DNS_TYPE_NAMES.get(rtype, rtype),
+                                dns_parse_rdata(data, offset, rtype,
+                                                rdlength)))
+                offset += rdlength
+    except (IndexError, struct.error, socket.error):
+        raise DNSError('Malformed response')
+    return qid, question, flags & 0xf, sections[0], sections[1]
+
+
+class Resolver(object):
+
+    # sends all the queries over a single udp socket without waiting for
+    # the previous answers, and matches the responses by id and question.
+    # unanswered queries are sent again when they time out, up to the given
+    # number of retries, trying the next nameserver. at most max_pending
+    # queries are waiting for answers at any time.
+
+    def __init__(self, nameservers=None, timeout=2.0, retries=2,
+                 max_pending=64):
+        if not nameservers:
+            nameservers = self.read_resolv_conf() or ['127.0.0.1']
+        self.nameservers = [self.parse_address(i) for i in nameservers]
+        self.timeout = timeout
+        self.retries = retries
+        self.max_pending = max_pending
+        family = socket.AF_INET
+        if ':' in self.nameservers[0][0]:
+            family = socket.AF_INET6
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.sent = 0
+
+    @staticmethod
+    def read_resolv_conf(fname='/etc/resolv.conf'):
+        nameservers = []
+        try:
+            with open(fname) as fp:
+                for line in fp:
+                    pieces = line.split()
+                    if len(pieces) > 1 and pieces[0] == 'nameserver':
+                        nameservers.append(pieces[1])
+        except IOError:
+            pass
+        return nameservers
+
+    @staticmethod
+    def parse_address(address):
+        # "1.2.3.4", "1.2.3.4:53", "::1" or "[::1]:53"
+        if address.startswith('['):
+            host, port = address[1:].split(']', 1)
+            return host, int(port.lstrip(':') or 53)
+        if address.count(':') == 1:
+            host, port = address.split(':')
+            return host, int(port)
+        return address, 53
+
+    def send(self, qid, query, attempt):
+        address = self.nameservers[attempt % len(self.nameservers)]
+        try:
+            self.sock.sendto(dns_build_query(qid, *query), address)
+        except socket.error, e:
+            log.debug('Failed to send query to %s: %s' % (address[0], e))
+        self.sent += 1
+
+    def query(self, queries):
+        # returns a dict mapping each (name, type) query to its rcode,
+        # answer and authority records, or to None if it timed out.
+        results = {}
+        pending = {}  # id: [query, attempt, deadline]
+        waiting = []  # [query, attempt]
+        for query in set(queries):
+            try:
+                dns_build_query(0, *query)
+            except DNSError, e:
+                log.warning(str(e))
+                results[query] = None
+                continue
+            waiting.append([query, 0])
+        waiting.reverse()
+        while waiting or pending:
+            while waiting and len(pending) < self.max_pending:
+                query, attempt = waiting.pop()
+                qid = self.new_id(pending)
+                pending[qid] = [query, attempt, time.time() + self.timeout]
+                self.send(qid, query, attempt)
+            timeout = min([i[2] for i in pending.itervalues()]) - time.time()
+            if timeout > 0 and select.select([self.sock], [], [], timeout)[0]:
+                self.receive(pending, results)
+            now = time.time()
+            for qid, (query, attempt, deadline) in pending.items():
+                if deadline > now:
+                    continue
+                del pending[qid]
+                if attempt >= self.retries:
+                    log.debug('Query timed out: %s %s' % (query[1],
+                                                          query[0]))
+                    results[query] = None
+                    continue
+                waiting.append([query, attempt + 1])
+        return results
+
+    def new_id(self, pending):
+        while True:
+            qid = random.randint(0, 0xffff)
+            if qid not in pending:
+                return qid
+
+    def receive(self, pending, results):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+            if address[:2] not in self.nameservers:
+                continue
+            try:
+                qid, question, rcode, answer, authority = \
+                    dns_parse_response(data)
+            except DNSError, e:
+                log.debug('Invalid response from %s: %s' % (address[0], e))
+                continue
+            if qid not in pending:
+                continue
+            query = pending[qid][0]
+            if question != (dns_name(query[0]), DNS_TYPES[query[1]]):
+                continue
+            del pending[qid]
+            results[query] = (rcode, answer, authority)
+
+    def close(self):
+        self.sock.close()
+
+
+def dns_hostname(url_or_hostname):
+    # same as get_hostname() from the dns module, without the trailing dot
+    # of fully qualified names
+    hostname = url_or_hostname
+    for prefix in ['https://', 'http://']:
+        if hostname.startswith(prefix):
+            hostname = hostname[len(prefix):]
+    return dns_name(hostname.split('/', 1)[0])
+
+
+def dns_records(result, rtype):
+    if result is None:
+        return []
+    return [i[3] for i in result[1] if i[2] == rtype]
+
+
+def dns_reverse_name(address):
+    return '.'.join(reversed(address.split('.'))) + '.in-addr.arpa'
+
+
+def dns_resolve(resolver, hostnames):
+    # runs all the queries needed by the reports of the hostnames, in three
+    # rounds, returning the results of Resolver.query(). the records of an
+    # alias are the records of the name it points to.
+    results = resolver.query([(i, j) for i in hostnames
+                              for j in ['A', 'NS', 'MX']])
+    hosts = []
+    for hostname in hostnames:
+        hosts.extend(dns_records(results[(hostname, 'NS')], 'NS'))
+        hosts.extend([i[1] for i in
+                      dns_records(results[(hostname, 'MX')], 'MX')])
+    results.update(resolver.query([(i, 'A') for i in hosts]))
+    addresses = []
+    for hostname in hostnames + hosts:
+        addresses.extend(dns_records(results[(hostname, 'A')], 'A'))
+    results.update(resolver.query([(dns_reverse_name(i), 'PTR')
+                                   for i in addresses]))
+    return results
+
+
+def dns_report(results, hostname):
+    # returns the report of a hostname from the results of dns_resolve(),
+    # with the same information as the json records of the dns module.
+    def cname(name):
+        # the first hop of an alias chain, the record of the name itself
+        result = results[(name, 'A')]
+        cnames = [i[3] for i in result and result[1] or []
+                  if i[2] == 'CNAME' and i[0].lower() == name.lower()]
+        return cnames and cnames[0] or ''
+
+    def a(name):
+        rv = []
+        for address in sorted(set(dns_records(results[(name, 'A')], 'A'))):
+            ptrs = dns_records(results[(dns_reverse_name(address), 'PTR')],
+                               'PTR')
+            rv.append({'address': address, 'ptr': ptrs and ptrs[-1] or ''})
+        return rv
+
+    ns = sorted(set(dns_records(results[(hostname, 'NS')], 'NS')))
+    mx = sorted(set(dns_records(results[(hostname, 'MX')], 'MX')))
+    return {'hostname': hostname,
+            'cname': cname(hostname),
+            'a': a(hostname),
+            'ns': [{'hostname': i, 'cname': cname(i), 'a': a(i)}
+                   for i in ns],
+            'mx': [{'hostname': j, 'priority': i, 'cname': cname(j),
+                    'a': a(j)} for i, j in mx]}
+
+
+def dns_report_queries(report):
+    # returns the queries a report was built from.
+    hostname = report['hostname']
+    queries = [(hostname, 'NS'), (hostname, 'MX')]
+    for entry in [report] + report['ns'] + report['mx']:
+        queries.append((entry['hostname'], 'A'))
+        queries.extend([(dns_reverse_name(i['address']), 'PTR')
+                        for i in entry['a']])
+    return queries
+
+
+def dns_report_records(report):
+    # returns the records shown in a report, as (name, type, value) tuples.
+    records = set()
+
+    def host(entry):
+        if entry['cname']:
+            records.add((entry['hostname'], 'CNAME', entry['cname']))
+        for i in entry['a']:
+            records.add((entry['hostname'], 'A', i['address']))
+            if i['ptr']:
+                records.add((i['address'], 'PTR', i['ptr']))
+
+    host(report)
+    for ns in report['ns']:
+        records.add((report['hostname'], 'NS', ns['hostname']))
+        host(ns)
+    for mx in report['mx']:
+        records.add((report['hostname'], 'MX',
+                     '%s %s' % (mx['priority'], mx['hostname'])))
+        host(mx)
+    return records
+
+
+def dns_report_text(report):
+    # same output of the dns module
+    def addresses(a, indent):
+        for i in a:
+            lines.append(indent + i['address'] +
+                         (i['ptr'] and ' -> ' + i['ptr'] or ''))
+
+    lines = ['Hostname: %s' % report['hostname']]
+    if report['cname']:
+        lines.append('CNAME: %s' % report['cname'])
+    if report['a']:
+        lines.extend(['', 'A records:'])
+        addresses(report['a'], ' ' * 4)
+    if report['ns']:
+        lines.extend(['', 'NS records:'])
+        for ns in report['ns']:
+            lines.append('    %s%s' % (ns['hostname'], ns['cname'] and
+                                       '(CNAME: %s)' % ns['cname'] or ''))
+            addresses(ns['a'], ' ' * 8)
+    if report['mx']:
+        lines.extend(['', 'MX records:'])
+        for mx in report['mx']:
+            lines.append('    %s (Priority: %s%s)' % (
+                mx['hostname'], mx['priority'],
+                mx['cname'] and ', CNAME: %s' % mx['cname'] or ''))
+            addresses(mx['a'], ' ' * 8)
+    return '\n'.join(lines)
+
+
+def hostnames(args):
+    if args['url_or_hostname']:
+        yield dns_hostname(args['url_or_hostname'])
+    if not args['input']:
+        return
+    fp = args['input'] == '-' and sys.stdin or open(args['input'])
+    try:
+        for line in fp:
+            hostname = dns_hostname(line.strip())
+            if hostname:
+                yield hostname
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def print_report(report, json_output, first):
+    if json_output:
+        print json.dumps(report, sort_keys=True)
+    else:
+        if not first:
+            print
+        print dns_report_text(report)
+
+
+def print_changes(hostname, added, removed, json_output):
+    now = time.time()
+    if json_output:
+        print json.dumps({'hostname': hostname, 'time': int(now),
+                          'added': sorted(added),
+                          'removed': sorted(removed)}, sort_keys=True)
+        return
+    now = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+    for sign, records in [('-', removed), ('+', added)]:
+        for record in sorted(records):
+            print '%s %s: %s %s' % (now, hostname, sign, ' '.join(record))
+
+
+def report(resolver, hostnames, json_output, first):
+    results = dns_resolve(resolver, hostnames)
+    for hostname in hostnames:
+        print_report(dns_report(results, hostname), json_output, first)
+        first = False
+    sys.stdout.flush()
+
+
+def watch(resolver, hostnames, interval, json_output):
+    # resolves each hostname again when the smallest TTL of the records in
+    # its report expires, or every interval seconds, and prints the records
+    # added or removed since the previous report. hostnames due at the same
+    # time are resolved together.
+    hostnames = sorted(set(hostnames), key=hostnames.index)
+    schedule = dict((i, 0) for i in hostnames)
+    snapshots = {}
+    try:
+        while True:
+            now = time.time()
+            due = [i for i in hostnames if schedule[i] <= now]
+            if not due:
+                time.sleep(min(schedule.values()) - now)
+                continue
+            results = dns_resolve(resolver, due)
+            for hostname in due:
+                report = dns_report(results, hostname)
+                queries = [results[i] for i in dns_report_queries(report)]
+                if None in queries:
+                    log.warning('Queries for %s timed out.' % hostname)
+                    schedule[hostname] = now + (interval or DEFAULT_INTERVAL)
+                    continue
+                ttls = [j[1] for i in queries for j in i[1] + i[2]]
+                schedule[hostname] = now + (interval or max(
+                    min(ttls or [DEFAULT_INTERVAL]), MIN_INTERVAL))
+                records = dns_report_records(report)
+                if hostname not in snapshots:
+                    print_report(report, json_output, not snapshots)
+                elif records != snapshots[hostname]:
+                    print_changes(hostname, records - snapshots[hostname],
+                                  snapshots[hostname] - records, json_output)
+                snapshots[hostname] = records
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_number(args, name, type, default):
+    if not args[name]:
+        return default
+    try:
+        return type(args[name])
+    except ValueError:
+        raise RuntimeError('invalid --%s: %s' % (name, args[name]))
+
+
+def main(args):
+    if not args['url_or_hostname'] and not args['input']:
+        raise RuntimeError('url_or_hostname or --input is required')
+    timeout = parse_number(args, 'timeout', float, 2.0)
+    retries = parse_number(args, 'retries', int, 2)
+    window = parse_number(args, 'window', int, 64)
+    interval = parse_number(args, 'interval', float, None)
+    nameservers = [i.strip() for i in args['nameservers'].split(',')
+                   if i.strip()]
+    resolver = Resolver(nameservers, timeout, retries)
+    try:
+        if args['watch']:
+            watch(resolver, list(hostnames(args)), interval, args['json'])
+            return 0
+        pending = []
+        first = True
+        for hostname in hostnames(args):
+            pending.append(hostname)
+            if len(pending) >= window:
+                report(resolver, pending, args['json'], first)
+                pending = []
+                first = False
+        if pending:
+            report(resolver, pending, args['json'], first)
+        log.debug('%d queries sent.' % resolver.sent)
+    finally:
+        resolver.close()
+    return 0
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from distutils.command.install_data import install_data
 from setuptools import setup
 import foo
 import glob
@@ -16,6 +17,16 @@ except ImportError:
     install_requires.append('argparse')
 
 
+class install_data_with_index(install_data):
+
+    def run(self):
+        install_data.run(self)
+        for path in set([os.path.dirname(i) for i in self.outfiles]):
+            if os.path.basename(path) == 'foo-tools' and not self.dry_run:
+                foo.write_module_index(path)
+                self.outfiles.append(os.path.join(path, foo.MODULE_INDEX))
+
+
 setup(
     name='foo-tools',
     version=foo.__version__,
@@ -29,7 +40,9 @@ setup(
     install_requires=install_requires,
     tests_require=['mock'],
     test_suite='test_foo',
-    data_files=[('libexec/foo-tools', glob.glob('modules/*'))],
+    data_files=[('libexec/foo-tools', glob.glob('modules/*')),
+                ('share/bash-completion/completions',
+                 ['bash-completion/foo'])],
     zip_safe=False,
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -42,4 +55,5 @@ setup(
         'Topic :: System',
     ],
     entry_points={'console_scripts': ['foo = foo:main']},
+    cmdclass={'install_data': install_data_with_index},
 )
@@ -7,18 +7,44 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import argparse
 import codecs
+import fcntl
+import json
 import mock
 import os
 import shutil
+import socket
+import struct
+import subprocess
 import sys
 import sysconfig
 import tempfile
+import threading
+import time
 import unittest
 from argparse import Namespace
+from cStringIO import StringIO
 
 import foo
-from foo import BashModule, Runner, main, re_parse_args
+from foo import BashModule, MetadataCache, ModuleIndex, PythonModule, \
+    Runner, Slots, get_re_parse_args, main
+
+
+_sleep = time.sleep
+_time = time.time
+
+
+def setUpModule():
+    global _cache_dir, _environ
+    _cache_dir = tempfile.mkdtemp()
+    _environ = mock.patch.dict('foo.os.environ', {'FOO_CACHE_DIR': _cache_dir})
+    _environ.start()
+
+
+def tearDownModule():
+    _environ.stop()
+    shutil.rmtree(_cache_dir)
 
 
 class BaseTestCase(unittest.TestCase):
@@ -35,7 +61,7 @@ class ReParseArgsTestCase(BaseTestCase):
 
     def test_argument(self):
         for arg in ['argument', 'arg-ument', 'arg_ument']:
-            rv = re_parse_args.match(arg)
+            rv = get_re_parse_args().match(arg)
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['argument'], arg)
             self.assertIsNone(rv.groupdict()['key'])
@@ -46,7 +72,7 @@ class ReParseArgsTestCase(BaseTestCase):
 
     def test_optional_argument(self):
         for arg in ['argument', 'arg-ument', 'arg_ument']:
-            rv = re_parse_args.match('[%s]' % arg)
+            rv = get_re_parse_args().match('[%s]' % arg)
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['argument'], arg)
             self.assertEquals(rv.groupdict()['lopt'], '[')
@@ -60,7 +86,7 @@ class ReParseArgsTestCase(BaseTestCase):
                      ('k_ey', 'value'), ('key', 'val-ue'),
                      ('key', 'val_ue'), ('k-ey', 'val-ue'),
                      ('k_ey', 'val_ue')]:
-            rv = re_parse_args.match('--%s=%s' % (k, v))
+            rv = get_re_parse_args().match('--%s=%s' % (k, v))
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['key_name'], k)
             self.assertEquals(rv.groupdict()['key'], '--%s' % k)
@@ -74,7 +100,7 @@ class ReParseArgsTestCase(BaseTestCase):
                      ('k_ey', 'value'), ('key', 'val-ue'),
                      ('key', 'val_ue'), ('k-ey', 'val-ue'),
                      ('k_ey', 'val_ue')]:
-            rv = re_parse_args.match('[--%s=%s]' % (k, v))
+            rv = get_re_parse_args().match('[--%s=%s]' % (k, v))
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['key_name'], k)
             self.assertEquals(rv.groupdict()['key'], '--%s' % k)
@@ -85,7 +111,7 @@ class ReParseArgsTestCase(BaseTestCase):
 
     def test_flag(self):
         for flag in ['flag', 'fla_g', 'fla-g']:
-            rv = re_parse_args.match('--%s' % flag)
+            rv = get_re_parse_args().match('--%s' % flag)
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['key_name'], flag)
             self.assertEquals(rv.groupdict()['key'], '--%s' % flag)
@@ -96,7 +122,7 @@ class ReParseArgsTestCase(BaseTestCase):
 
     def test_optional_flag(self):
         for flag in ['flag', 'fla_g', 'fla-g']:
-            rv = re_parse_args.match('[--%s]' % flag)
+            rv = get_re_parse_args().match('[--%s]' % flag)
             self.assertIsNotNone(rv)
             self.assertEquals(rv.groupdict()['key_name'], flag)
             self.assertEquals(rv.groupdict()['key'], '--%s' % flag)
@@ -139,6 +165,71 @@ class BashModuleTestCase(BaseTestCase):
         self.assertEquals(meta['fuu'], 'asdfa')
         self.assertEquals(len(meta), 6)
 
+    def _write_metadata_module(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'FOO_LOL=asdf'
+            print >> fp, 'FOO_BAR="asdfa"'
+            print >> fp, 'FOO_XD=1234'
+            print >> fp, 'FOO_ASDF="1234"'
+            print >> fp, 'FOO_HEHE="${FOO_ASDF}"'
+            print >> fp, 'FOO_FUU=${FOO_BAR}'
+            print >> fp, 'FOO_DFGDS'
+            print >> fp, 'ASDF=XD'
+            print >> fp
+            print >> fp, 'main() { echo 1 }'
+
+    def _assert_metadata(self, meta):
+        self.assertEquals(meta['lol'], 'asdf')
+        self.assertEquals(meta['bar'], 'asdfa')
+        self.assertEquals(meta['xd'], '1234')
+        self.assertEquals(meta['asdf'], '1234')
+        self.assertEquals(meta['hehe'], '1234')
+        self.assertEquals(meta['fuu'], 'asdfa')
+        self.assertEquals(len(meta), 6)
+
+    @mock.patch('subprocess.check_output')
+    def test_get_metadata_static(self, check_output):
+        self._write_metadata_module()
+        self._assert_metadata(BashModule(self.module).get_metadata())
+        self.assertFalse(check_output.called)
+
+    @mock.patch('foo.parse_metadata')
+    def test_get_metadata_sourced(self, parse_metadata):
+        parse_metadata.return_value = None
+        self._write_metadata_module()
+        self._assert_metadata(BashModule(self.module).get_metadata())
+        parse_metadata.assert_called_once_with(self.module)
+
+    def test_get_metadata_fallback(self):
+        for line in ['FOO_HELP="$(echo asdf)"', 'FOO_HELP=`echo asdf`',
+                     'FOO_HELP="${HOME:+asdf}"',
+                     'FOO_HELP=asdf; FOO_USAGE=bar',
+                     'true && FOO_HELP=asdf',
+                     'source /dev/null',
+                     'if true; then\nFOO_HELP=asdf\nfi',
+                     'main() { :; }\nFOO_HELP=asdf']:
+            with codecs.open(self.module, 'w', 'utf-8') as fp:
+                print >> fp, line
+            self.assertIsNone(foo.parse_metadata(self.module))
+            if not line.startswith('source'):
+                meta = BashModule(self.module).get_metadata()
+                self.assertEquals(meta.get('help'), 'asdf')
+
+    def test_parse_bash_value(self):
+        variables = {'FOO_A': '1'}
+        for value, expected in [('asdf', 'asdf'), ('"a b"', 'a b'),
+                                ("'x $FOO_A'", 'x $FOO_A'),
+                                ('"${FOO_A}-$FOO_A"', '1-1'),
+                                ('a"b"\'c\'', 'abc'),
+                                ('"\\"q\\$"', '"q$'),
+                                ('x # comment', 'x'),
+                                ('$FOO_B', ''),
+                                ('$(date)', None), ('$HOME', None),
+                                ('a b', None), ('~/x', None),
+                                ('"unterminated', None)]:
+            self.assertEquals(foo.parse_bash_value(value, variables),
+                              expected)
+
     @mock.patch('foo.BashModule.get_metadata')
     def test_build_argparse(self, get_metadata):
         get_metadata.return_value = {'usage': ('foo --bar --baz=bah [asd] '
@@ -166,6 +257,20 @@ class BashModuleTestCase(BaseTestCase):
                                      help='lol6')])
         parser.set_defaults.called_once_with(_module=obj)
 
+    @mock.patch('foo.BashModule.get_metadata')
+    def test_build_argparse_dashed(self, get_metadata):
+        # bash variables can't have dashes, FOO_HELP_BYPASS_CACHE is the
+        # help of --bypass-cache
+        get_metadata.return_value = {'usage': '[--bypass-cache] '
+                                     '[--max-age=seconds] url-or-host',
+                                     'help_bypass_cache': 'bypass1',
+                                     'help_max_age': 'max2',
+                                     'help_url_or_host': 'url3'}
+        parser = BashModule(self.module).build_argparse(mock.Mock())
+        self.assertEquals([i[1]['help'] for i in
+                           parser.add_argument.call_args_list],
+                          ['bypass1', 'max2', 'url3'])
+
     @mock.patch('foo.BashModule.get_metadata')
     def test_build_argparse_with_invalid_arg(self, get_metadata):
         get_metadata.return_value = {'usage': ('foo1'),
@@ -175,13 +280,13 @@ class BashModuleTestCase(BaseTestCase):
         with self.assertRaises(RuntimeError):
             obj.build_argparse(subparser)
 
-    @mock.patch('foo.subprocess.Popen')
+    @mock.patch('subprocess.Popen')
     def test_run(self, Popen):
         with codecs.open(self.module, 'w', 'utf-8') as fp:
             print >> fp, 'main() { echo 1 }'
         with mock.patch.dict('foo.os.environ',
-                             {'PATH': '/', 'LC_ALL': 'en_US.utf8'},
-                             clear=True):
+                             {'PATH': '/', 'LC_ALL': 'en_US.utf8',
+                              'FOO_CACHE_DIR': '/cache'}, clear=True):
             obj = BashModule(self.module)
             obj.run({'foo': 'bar', 'bar': ['baz'], 'lol': None})
         script = Popen.call_args[0][0][2]  # wtf?
@@ -195,7 +300,477 @@ class BashModuleTestCase(BaseTestCase):
         self.assertEquals(env['FOO_ARG_FOO'], 'bar')
         self.assertEquals(env['FOO_ARG_BAR'], 'baz')
         self.assertEquals(env['FOO_ARG_LOL'], '')
-        self.assertEquals(len(env), 5)
+        self.assertEquals(env['FOO_MODULE_CACHE_DIR'], '/cache/modules/module')
+        self.assertEquals(len(env), 6)
+
+    @mock.patch('subprocess.Popen')
+    @mock.patch('foo.os.execve')
+    def test_run_replace(self, execve, Popen):
+        execve.side_effect = SystemExit  # execve never returns
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { echo 1 }'
+        with mock.patch.dict('foo.os.environ',
+                             {'PATH': '/', 'FOO_CACHE_DIR': '/cache'},
+                             clear=True):
+            obj = BashModule(self.module)
+            with self.assertRaises(SystemExit):
+                obj.run({'foo': 'bar'}, replace=True)
+        self.assertFalse(Popen.called)
+        path, argv, env = execve.call_args[0]
+        self.assertEquals(path, '/bin/bash')
+        self.assertEquals(argv[:2], ['/bin/bash', '-c'])
+        self.assertIn('log_critical() {', argv[2])
+        self.assertIn(self.module, argv[2])
+        self.assertEquals(env, {'PATH': '/', 'FOO_ARG_FOO': 'bar',
+                                'FOO_MODULE_CACHE_DIR':
+                                '/cache/modules/module'})
+
+    def test_compile(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { echo 1; }'
+        compile_dir = os.path.join(self.tmpdir, 'compiled')
+        obj = BashModule(self.module, compile_dir=compile_dir)
+        launcher = obj.compile()
+        self.assertEquals(obj.compile(), launcher)
+        with open(launcher) as fp:
+            content = fp.read()
+        self.assertTrue(content.startswith('#!/bin/bash\n'))
+        self.assertIn('FOO_MODULE_NAME="module"', content)
+        self.assertIn(self.module, content)
+        self.assertTrue(os.access(launcher, os.X_OK))
+        prelude = foo.compile_prelude(compile_dir)
+        self.assertIn(prelude, content)
+        with open(prelude) as fp:
+            content = fp.read()
+        for func in ['log_debug', 'log_info', 'log_warning', 'log_error',
+                     'log_critical', 'die']:
+            self.assertIn('%s() {' % func, content)
+        self.assertIn('foo.${FOO_MODULE_NAME} - DEBUG:', content)
+
+    def test_compile_invalidated(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { echo 1; }'
+        compile_dir = os.path.join(self.tmpdir, 'compiled')
+        obj = BashModule(self.module, compile_dir=compile_dir)
+        launcher = obj.compile()
+        with codecs.open(self.module, 'a', 'utf-8') as fp:
+            print >> fp, 'main() { echo 2; }'
+        launcher2 = obj.compile()
+        self.assertNotEquals(launcher, launcher2)
+        self.assertTrue(os.path.exists(launcher))
+        with mock.patch.object(foo, '__version__', 'lol'):
+            self.assertNotEquals(obj.compile(), launcher2)
+
+    @mock.patch('subprocess.Popen')
+    def test_run_compiled(self, Popen):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { echo 1; }'
+        obj = BashModule(self.module,
+                         compile_dir=os.path.join(self.tmpdir, 'compiled'))
+        with mock.patch.dict('foo.os.environ',
+                             {'PATH': '/', 'FOO_CACHE_DIR': '/cache'},
+                             clear=True):
+            obj.run({'foo': 'bar'})
+        Popen.assert_called_once_with(['/bin/bash', obj.compile()],
+                                      env={'PATH': '/', 'FOO_ARG_FOO': 'bar',
+                                           'FOO_MODULE_CACHE_DIR':
+                                           '/cache/modules/module'},
+                                      stdout=None, stderr=None)
+
+    def test_run_compiled_exit_status(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { log_error "lol"; exit 3; }'
+        obj = BashModule(self.module,
+                         compile_dir=os.path.join(self.tmpdir, 'compiled'))
+        self.assertEquals(obj.run({}), 3)
+
+    def test_run_exit_status(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { die "lol"; }'
+        with mock.patch('foo.sys.stderr'):
+            self.assertEquals(BashModule(self.module).run({}), 1)
+
+
+class PythonModuleTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.module = os.path.join(self.tmpdir, 'module.py')
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write_module(self, *lines):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            for line in lines:
+                print >> fp, line
+
+    def test_name(self):
+        self.assertEquals(PythonModule(self.module).name, 'module')
+        self.assertEquals(PythonModule(self.tmpdir + '/lol').name, 'lol')
+
+    def test_get_metadata_static(self):
+        self._write_module('import sys',
+                           'FOO_HELP = "dummy"',
+                           'FOO_USAGE = FOO_LOL = "--foo [bar]"',
+                           'def main(args):',
+                           '    raise RuntimeError("not expected to run")')
+        self.assertEquals(PythonModule(self.module).get_metadata(),
+                          {'help': 'dummy', 'usage': '--foo [bar]',
+                           'lol': '--foo [bar]'})
+
+    def test_get_metadata_sourced(self):
+        for lines in [['FOO_HELP = "".join(["dum", "my"])'],
+                      ['FOO_HELP = ""', 'FOO_HELP += "dummy"'],
+                      ['if True:', '    FOO_HELP = "dummy"'],
+                      ['FOO_HELP, FOO_LOL = "dummy", 1']]:
+            self._write_module(*lines)
+            obj = PythonModule(self.module)
+            self.assertIsNone(obj.parse_metadata())
+            self.assertEquals(obj.get_metadata(source=False)['help'],
+                              'dummy')
+
+    def test_build_argparse(self):
+        self._write_module('FOO_HELP = "dummy"',
+                           'FOO_USAGE = "--foo [bar]"',
+                           'FOO_HELP_BAR = "bar1"')
+        subparser = mock.Mock()
+        obj = PythonModule(self.module)
+        parser = obj.build_argparse(subparser)
+        subparser.add_parser.assert_called_once_with('module', help='dummy')
+        self.assertEquals(parser.add_argument.call_args_list,
+                          [mock.call('--foo', required=True,
+                                     action='store_const', const='1',
+                                     help=None),
+                           mock.call('bar', help='bar1', nargs='?')])
+
+    @mock.patch('subprocess.Popen')
+    def test_run(self, Popen):
+        self._write_module('import os',
+                           'def main(args):',
+                           '    return int(args["foo"]) + len(os.sep)')
+        self.assertEquals(PythonModule(self.module).run({'foo': '2'}), 3)
+        self.assertFalse(Popen.called)
+
+    def test_run_without_return(self):
+        self._write_module('def main(args):', '    pass')
+        self.assertEquals(PythonModule(self.module).run({}), 0)
+
+    def test_run_without_main(self):
+        self._write_module('FOO_HELP = "dummy"')
+        with self.assertRaises(RuntimeError):
+            PythonModule(self.module).run({})
+
+
+class LoadMetadataTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write_modules(self, count, line='FOO_HELP="$(echo help-%d)"'):
+        modules = []
+        for i in range(count):
+            module = os.path.join(self.tmpdir, 'module%d' % i)
+            with codecs.open(module, 'w', 'utf-8') as fp:
+                print >> fp, line % i
+            modules.append(BashModule(module))
+        return modules
+
+    def test_source_metadata_batch(self):
+        modules = self._write_modules(3)
+        with codecs.open(modules[1].fname, 'a', 'utf-8') as fp:
+            print >> fp, 'exit 1'
+        fnames = [module.fname for module in modules]
+        rv = foo.source_metadata_batch(fnames)
+        self.assertEquals(rv, {fnames[0]: {'help': 'help-0'},
+                               fnames[2]: {'help': 'help-2'}})
+
+    def test_load_metadata(self):
+        modules = self._write_modules(20)
+        with mock.patch('subprocess.Popen', wraps=subprocess.Popen) \
+                as Popen:
+            foo.load_metadata(modules, workers=2)
+        self.assertEquals(Popen.call_count, 2)
+        for i, module in enumerate(modules):
+            self.assertEquals(module.get_metadata(), {'help': 'help-%d' % i})
+
+    def test_load_metadata_small(self):
+        modules = self._write_modules(5)
+        with mock.patch('subprocess.Popen', wraps=subprocess.Popen) \
+                as Popen:
+            foo.load_metadata(modules, workers=4)
+        self.assertEquals(Popen.call_count, 1)
+
+    @mock.patch('subprocess.Popen')
+    def test_load_metadata_static(self, Popen):
+        modules = self._write_modules(5, line='FOO_HELP="help-%d"')
+        foo.load_metadata(modules)
+        self.assertFalse(Popen.called)
+        for i, module in enumerate(modules):
+            self.assertEquals(module.get_metadata(), {'help': 'help-%d' % i})
+
+    def test_load_metadata_failed(self):
+        modules = self._write_modules(2)
+        with codecs.open(modules[0].fname, 'a', 'utf-8') as fp:
+            print >> fp, 'exit 1'
+        foo.load_metadata(modules)
+        self.assertEquals(modules[1].get_metadata(), {'help': 'help-1'})
+        with self.assertRaises(subprocess.CalledProcessError):
+            modules[0].get_metadata()
+
+
+class MetadataCacheTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.module = os.path.join(self.tmpdir, 'module')
+        self.cache_file = os.path.join(self.tmpdir, 'cache', 'metadata.json')
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'FOO_HELP="asdf"'
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_metadata_cached(self):
+        cache = MetadataCache(self.cache_file)
+        BashModule(self.module, cache).get_metadata()
+        cache.save()
+        self.assertFalse(cache.dirty)
+        cache = MetadataCache(self.cache_file)
+        with mock.patch('subprocess.check_output') as check_output:
+            meta = BashModule(self.module, cache).get_metadata()
+        self.assertFalse(check_output.called)
+        self.assertEquals(meta, {'help': 'asdf'})
+
+    def test_get_metadata_cached_non_ascii(self):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, u'FOO_HELP="an\xe1lise de DNS"'
+        for i in range(2):
+            cache = MetadataCache(self.cache_file)
+            meta = BashModule(self.module, cache).get_metadata()
+            cache.save()
+            self.assertEquals(meta, {'help': 'an\xc3\xa1lise de DNS'})
+            self.assertTrue(all([isinstance(j, str) for j in
+                                 meta.keys() + meta.values()]))
+        # the help of a parser built from the cached metadata can be written
+        # to a byte stream
+        parser = argparse.ArgumentParser()
+        BashModule(self.module, cache).build_argparse(
+            parser.add_subparsers())
+        output = StringIO()
+        parser.print_help(output)
+        self.assertIn('an\xc3\xa1lise de DNS', output.getvalue())
+
+    def test_save(self):
+        cache = MetadataCache(self.cache_file)
+        BashModule(self.module, cache).get_metadata()
+        cache.save()
+        cache = MetadataCache(self.cache_file)
+        key = cache.stat(self.module)
+        self.assertEquals(cache.get(self.module, key), {'help': 'asdf'})
+
+    def test_invalidated(self):
+        cache = MetadataCache(self.cache_file)
+        BashModule(self.module, cache).get_metadata()
+        with codecs.open(self.module, 'a', 'utf-8') as fp:
+            print >> fp, 'FOO_USAGE="--bar"'
+        meta = BashModule(self.module, cache).get_metadata()
+        self.assertEquals(meta, {'help': 'asdf', 'usage': '--bar'})
+
+    def test_prune(self):
+        cache = MetadataCache(self.cache_file)
+        BashModule(self.module, cache).get_metadata()
+        cache.save()
+        cache.prune([])
+        self.assertTrue(cache.dirty)
+        self.assertEquals(cache.entries, {})
+
+    def test_rebuild(self):
+        cache = MetadataCache(self.cache_file)
+        BashModule(self.module, cache).get_metadata()
+        cache.save()
+        cache = MetadataCache(self.cache_file, rebuild=True)
+        self.assertEquals(cache.entries, {})
+
+    def test_load_corrupted(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as fp:
+            print >> fp, '{lol'
+        cache = MetadataCache(self.cache_file)
+        self.assertEquals(cache.entries, {})
+
+
+class ModuleIndexTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmpdir, 'modules.json')
+        self.paths = []
+        for name in ['user', 'global']:
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(path)
+            os.utime(path, (1, 1))
+            self.paths.append(path)
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _module(self, i, name, kind='bash'):
+        return (os.path.join(self.paths[i], name), kind)
+
+    def _touch(self, path, name, mtime=1):
+        with open(os.path.join(path, name), 'w') as fp:
+            print >> fp
+        os.utime(path, (mtime, mtime))
+
+    def test_resolve(self):
+        self._touch(self.paths[0], 'foo')
+        self._touch(self.paths[1], 'foo')
+        self._touch(self.paths[1], 'bar')
+        os.makedirs(os.path.join(self.paths[1], 'baz'))
+        os.utime(self.paths[1], (1, 1))
+        index = ModuleIndex(self.index_file)
+        self.assertEquals(index.resolve(self.paths),
+                          {'foo': self._module(0, 'foo'),
+                           'bar': self._module(1, 'bar')})
+        index.save()
+        with mock.patch('foo.os.listdir') as listdir:
+            index = ModuleIndex(self.index_file)
+            self.assertEquals(index.resolve(self.paths),
+                              {'foo': self._module(0, 'foo'),
+                               'bar': self._module(1, 'bar')})
+        self.assertFalse(listdir.called)
+        self.assertFalse(index.dirty)
+
+    def test_resolve_revalidated(self):
+        self._touch(self.paths[1], 'foo')
+        index = ModuleIndex(self.index_file)
+        index.resolve(self.paths)
+        index.save()
+        self._touch(self.paths[0], 'bar', mtime=2)
+        index = ModuleIndex(self.index_file)
+        with mock.patch('foo.os.listdir', wraps=os.listdir) as listdir:
+            self.assertEquals(index.resolve(self.paths),
+                              {'foo': self._module(1, 'foo'),
+                               'bar': self._module(0, 'bar')})
+        listdir.assert_called_once_with(self.paths[0])
+
+    def test_resolve_recently_changed(self):
+        self._touch(self.paths[0], 'foo')
+        os.utime(self.paths[0], None)
+        index = ModuleIndex(self.index_file)
+        self.assertEquals(index.resolve(self.paths),
+                          {'foo': self._module(0, 'foo')})
+        self.assertFalse(index.dirty)
+
+    def test_resolve_installed_index(self):
+        self._touch(self.paths[1], 'foo')
+        foo.write_module_index(self.paths[1])
+        self._touch(self.paths[1], 'bar')
+        with mock.patch('foo.os.listdir', wraps=os.listdir) as listdir:
+            self.assertEquals(ModuleIndex(self.index_file).resolve(self.paths),
+                              {'foo': self._module(1, 'foo')})
+        listdir.assert_called_once_with(self.paths[0])
+        os.utime(self.paths[1], None)
+        self.assertEquals(ModuleIndex(self.index_file).resolve(self.paths),
+                          {'foo': self._module(1, 'foo'),
+                           'bar': self._module(1, 'bar')})
+
+    def test_resolve_python(self):
+        self._touch(self.paths[0], 'foo.py')
+        self._touch(self.paths[0], 'bar')
+        with open(os.path.join(self.paths[0], 'bar'), 'w') as fp:
+            print >> fp, '#!/usr/bin/env python'
+        self._touch(self.paths[1], 'foo')
+        self._touch(self.paths[1], 'baz')
+        self._touch(self.paths[1], 'baz.py')
+        os.utime(self.paths[0], (1, 1))
+        self.assertEquals(ModuleIndex(self.index_file).resolve(self.paths),
+                          {'foo': self._module(0, 'foo.py', 'python'),
+                           'bar': self._module(0, 'bar', 'python'),
+                           'baz': self._module(1, 'baz.py', 'python')})
+
+
+class CompleteTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for i in range(50):
+            with codecs.open(os.path.join(self.tmpdir, 'module%02d' % i), 'w',
+                             'utf-8') as fp:
+                print >> fp, 'FOO_USAGE="--foo --bar=baz [--lol] asd"'
+        self._search_paths = mock.patch('foo.search_paths')
+        self._search_paths.start().return_value = [self.tmpdir]
+
+    def tearDown(self):
+        self._search_paths.stop()
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_modules(self):
+        self.assertEquals(foo.complete('foo '),
+                          ['batch', 'compile'] +
+                          ['module%02d' % i for i in range(50)] +
+                          ['pipe', 'slots'])
+        self.assertEquals(foo.complete('foo module1'),
+                          ['module%02d' % i for i in range(10, 20)])
+        self.assertEquals(foo.complete('foo --log-level INFO module0'),
+                          ['module%02d' % i for i in range(10)])
+
+    def test_global_options(self):
+        self.assertEquals(foo.complete('foo --'),
+                          ['--client', '--help', '--log-level=',
+                           '--no-cache', '--profile', '--queue-timeout=',
+                           '--rebuild-cache', '--server', '--socket=',
+                           '--traceback', '--version'])
+        self.assertEquals(foo.complete('foo --log-level '),
+                          ['CRITICAL', 'DEBUG', 'ERROR', 'INFO', 'NOTSET',
+                           'WARNING'])
+        self.assertEquals(foo.complete('foo --log-level=WA'), ['WARNING'])
+
+    def test_module_options(self):
+        self.assertEquals(foo.complete('foo module00 -'),
+                          ['--bar=', '--foo', '--help', '--lol', '-h'])
+        self.assertEquals(foo.complete('foo module00 --foo --b'), ['--bar='])
+        self.assertEquals(foo.complete('foo module00 --bar '), [])
+        self.assertEquals(foo.complete('foo module00 --bar=x --'),
+                          ['--foo', '--help', '--lol'])
+        self.assertEquals(foo.complete('foo nope -'), [])
+        self.assertEquals(foo.complete('foo "module00'), [])
+
+    def test_latency(self):
+        foo.complete('foo ')  # warm up the module index
+        with mock.patch('subprocess.Popen') as Popen:
+            with mock.patch('subprocess.check_output') as check_output:
+                start = time.time()
+                for i in range(100):
+                    foo.complete('foo module%02d --' % (i % 50))
+                elapsed = (time.time() - start) / 100
+        self.assertFalse(Popen.called)
+        self.assertFalse(check_output.called)
+        self.assertLess(elapsed, 0.01)
+
+    @mock.patch('foo.complete')
+    def test_main(self, complete):
+        complete.return_value = ['--bar=', '--foo']
+        with mock.patch.object(sys, 'argv', ['foo', '--complete',
+                                             'foo module00 --']):
+            with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                self.assertEquals(main(), 0)
+        complete.assert_called_once_with('foo module00 --')
+        self.assertEquals(stdout.getvalue(), '--bar=\n--foo\n')
 
 
 class RunnerTestCase(BaseTestCase):
@@ -209,6 +784,7 @@ class RunnerTestCase(BaseTestCase):
         super(BaseTestCase, self).tearDown()
         shutil.rmtree(self.tmpdir)
 
+    @mock.patch('foo._sysconfig_base', None)
     @mock.patch('foo.sysconfig.get_config_var')
     @mock.patch('foo.os.path.expanduser')
     def test_search_paths_not_created(self, expanduser, get_config_var):
@@ -219,6 +795,7 @@ class RunnerTestCase(BaseTestCase):
         self.assertEquals(runner.search_paths(),
                           [os.path.join(cwd, 'modules')])
 
+    @mock.patch('foo._sysconfig_base', None)
     @mock.patch('foo.os.path.isdir')
     def test_search_paths(self, isdir):
         isdir.return_value = True
@@ -249,6 +826,17 @@ class RunnerTestCase(BaseTestCase):
         self.assertIn('foo', modules)
         self.assertIn('bar', modules)
 
+    @mock.patch('foo.Runner.search_paths')
+    def test_python_modules(self, search_paths):
+        with open(os.path.join(self.tmpdir, 'foo.py'), 'w') as fp:
+            print >> fp
+        with open(os.path.join(self.tmpdir, 'bar'), 'w') as fp:
+            print >> fp
+        search_paths.return_value = [self.tmpdir]
+        modules = Runner().modules()
+        self.assertIsInstance(modules['foo'], PythonModule)
+        self.assertIsInstance(modules['bar'], BashModule)
+
     @mock.patch('foo.Runner.search_paths')
     def test_duplicated_modules(self, search_paths):
         _subdir = os.path.join(self.tmpdir, 'modules')
@@ -275,13 +863,1042 @@ class RunnerTestCase(BaseTestCase):
         parser.parse_args.return_value = Namespace(foo='bar', bar=['baz'],
                                                    _lol='hehe', xd=None,
                                                    log_level='NOTSET',
+                                                   _queue_timeout=None,
                                                    _module=module)
         with mock.patch.object(sys, 'argv', ['foo', 'bar', '--traceback']):
             runner.run()
         module.build_argparse.assert_called_once_with(runner.subparser)
         parser.parse_args.assert_called_once_with(['bar'])
         module.run.assert_called_once_with({'bar': 'baz', 'foo': 'bar',
-                                            'log_level': '0', 'xd': ''})
+                                            'log_level': '0', 'xd': ''},
+                                           replace=True)
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_builds_invoked_module_only(self, modules):
+        module, other = mock.Mock(), mock.Mock()
+        modules.return_value = {'foo': module, 'bar': other}
+        runner = Runner()
+        runner.parser = parser = mock.Mock()
+        parser.parse_args.return_value = Namespace(log_level='WARNING',
+                                                   _queue_timeout=None,
+                                                   _module=module)
+        with mock.patch.object(sys, 'argv', ['foo', '--log-level', 'INFO',
+                                             'foo', '--help']):
+            runner.run()
+        module.build_argparse.assert_called_once_with(runner.subparser)
+        self.assertFalse(other.build_argparse.called)
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_builds_all_modules_for_help(self, modules):
+        module, other = mock.Mock(), mock.Mock()
+        modules.return_value = {'foo': module, 'bar': other}
+        runner = Runner()
+        runner.parser = parser = mock.Mock()
+        parser.parse_args.return_value = Namespace(log_level='WARNING',
+                                                   _queue_timeout=None,
+                                                   _module=module)
+        with mock.patch.object(sys, 'argv', ['foo', '--help', 'foo']):
+            runner.run()
+        module.build_argparse.assert_called_once_with(runner.subparser)
+        other.build_argparse.assert_called_once_with(runner.subparser)
+
+    def test_find_module_name(self):
+        runner = Runner()
+        for argv, name in [([], None),
+                           (['foo'], 'foo'),
+                           (['--traceback', 'foo', 'bar'], 'foo'),
+                           (['--log-level', 'DEBUG', 'foo'], 'foo'),
+                           (['--log-level=DEBUG', 'foo'], 'foo'),
+                           (['--log', 'DEBUG', 'foo'], 'foo'),
+                           (['--profile', 'foo'], 'foo'),
+                           (['--profile', 'json', 'foo'], 'foo'),
+                           (['-h', 'foo'], None),
+                           (['--help'], None),
+                           (['--', 'foo'], 'foo'),
+                           (['foo', '--help'], 'foo')]:
+            self.assertEquals(runner.find_module_name(argv), name)
+
+    @mock.patch('foo.Runner.modules')
+    def test_compile_command(self, modules):
+        compile_dir = os.path.join(self.tmpdir, 'compiled')
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'main() { echo 1; }'
+        module = BashModule(self.module, None, compile_dir)
+        modules.return_value = {'module': module}
+        os.makedirs(compile_dir)
+        with open(os.path.join(compile_dir, 'stale'), 'w') as fp:
+            print >> fp
+        with mock.patch.object(sys, 'argv', ['foo', 'compile']):
+            self.assertEquals(Runner().run(), 0)
+        prelude = foo.compile_prelude(compile_dir)
+        self.assertEquals(sorted(os.listdir(compile_dir)),
+                          sorted([os.path.basename(prelude),
+                                  os.path.basename(module.compile())]))
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_cached(self, modules):
+        counter = os.path.join(self.tmpdir, 'counter')
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'FOO_USAGE="value"'
+            print >> fp, 'FOO_CACHE_TTL="60"'
+            print >> fp, 'main() {'
+            print >> fp, '    echo x >> "%s"' % counter
+            print >> fp, '    echo "value: ${FOO_ARG_VALUE}"'
+            print >> fp, '    return 3'
+            print >> fp, '}'
+        modules.return_value = {'module': BashModule(self.module)}
+
+        def run(*argv):
+            with mock.patch.object(sys, 'argv', ['foo'] + list(argv)):
+                with mock.patch('sys.stdout',
+                                new_callable=StringIO) as stdout:
+                    rv = Runner().run()
+            with open(counter) as fp:
+                runs = len(fp.readlines())
+            return rv, stdout.getvalue(), runs
+
+        self.assertEquals(run('module', 'a'), (3, 'value: a\n', 1))
+        self.assertEquals(run('module', 'a'), (3, 'value: a\n', 1))
+        self.assertEquals(run('module', 'b'), (3, 'value: b\n', 2))
+        self.assertEquals(run('--no-cache', 'module', 'a'),
+                          (3, 'value: a\n', 3))
+        with mock.patch('foo.time.time') as time_:
+            time_.return_value = _time() + 61
+            self.assertEquals(run('module', 'a'), (3, 'value: a\n', 4))
+
+    def test_result_cache_evict(self):
+        cache = foo.ResultCache(self.tmpdir, max_size=12)
+        for i in range(3):
+            cache.set('entry%d' % i, 0, 'abcd')
+            os.utime(os.path.join(self.tmpdir, 'entry%d' % i), (i, i))
+        cache.set('entry3', 0, 'abcd')
+        self.assertEquals(sorted(os.listdir(self.tmpdir)),
+                          ['entry2', 'entry3'])
+        self.assertEquals(cache.get('entry3', 60), (0, 'abcd'))
+        self.assertIsNone(cache.get('entry2', 60))
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_profile(self, modules):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'main() { return 3; }'
+        modules.return_value = {'module': BashModule(self.module)}
+        with mock.patch.object(sys, 'argv', ['foo', '--profile', 'module']):
+            with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+                self.assertEquals(Runner().run(), 3)
+        self.assertFalse(foo.profiler.enabled)
+        lines = stderr.getvalue().splitlines()
+        names = [i.split()[0] for i in lines[1:-2]]
+        self.assertEquals(names, ['setup', 'load', 'find', 'build', 'parse',
+                                  'save', 'parse', 'run'])
+        self.assertTrue(lines[-2].startswith('total '))
+        self.assertTrue(lines[-1].startswith('children: user '))
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_profile_json(self, modules):
+        with codecs.open(self.module, 'w', 'utf-8') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'main() { return 0; }'
+        modules.return_value = {'module': BashModule(self.module)}
+        with mock.patch.dict(os.environ, {'FOO_PROFILE': 'json'}):
+            with mock.patch.object(sys, 'argv', ['foo', 'module']):
+                with mock.patch('sys.stderr',
+                                new_callable=StringIO) as stderr:
+                    self.assertEquals(Runner().run(), 0)
+        report = json.loads(stderr.getvalue())
+        phases = [(i['name'], i['depth']) for i in report['phases']]
+        self.assertEquals(phases, [('setup', 0),
+                                   ('load metadata cache', 1),
+                                   ('find modules', 1),
+                                   ('build parser module', 1),
+                                   ('parse metadata module', 2),
+                                   ('save metadata cache', 1),
+                                   ('parse arguments', 0),
+                                   ('run module', 0)])
+        self.assertGreater(report['children']['maxrss'], 0)
+        self.assertGreaterEqual(report['wall'], report['phases'][-1]['wall'])
+
+    @mock.patch('foo.Runner.modules')
+    def test_run_profile_usage_error(self, modules):
+        modules.return_value = {'module': BashModule(self.module)}
+        with mock.patch.object(sys, 'argv', ['foo', '--profile', 'json',
+                                             'module', '--lol']):
+            with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+                self.assertRaises(SystemExit, Runner().run)
+        self.assertFalse(foo.profiler.enabled)
+        self.assertIn('unrecognized arguments: --lol', stderr.getvalue())
+        self.assertNotIn('"phases"', stderr.getvalue())
+
+    def test_profile_format(self):
+        runner = Runner()
+        argv = ['--profile', 'module', '--profile']
+        self.assertEquals(runner.profile_format(argv), 'text')
+        self.assertEquals(argv, ['module', '--profile'])
+        argv = ['--profile=json', 'module']
+        self.assertEquals(runner.profile_format(argv), 'json')
+        self.assertEquals(argv, ['module'])
+        argv = ['--profile', 'json', '--no-cache', 'module', 'text']
+        self.assertEquals(runner.profile_format(argv), 'json')
+        self.assertEquals(argv, ['--no-cache', 'module', 'text'])
+        self.assertIsNone(runner.profile_format(['module']))
+        with mock.patch('sys.stderr', new_callable=StringIO):
+            self.assertRaises(SystemExit, runner.profile_format,
+                              ['--profile=xml', 'module'])
+        for value, fmt in [('', None), ('0', None), ('false', None),
+                           ('No', None), ('1', 'text'), ('text', 'text'),
+                           ('json', 'json')]:
+            with mock.patch.dict(os.environ, {'FOO_PROFILE': value}):
+                self.assertEquals(runner.profile_format(['module']), fmt)
+        with mock.patch.dict(os.environ, {'FOO_PROFILE': 'xml'}):
+            with mock.patch.object(foo.log, 'warning') as warning:
+                self.assertIsNone(runner.profile_format(['module']))
+            warning.assert_called_once_with('Invalid $FOO_PROFILE: xml')
+
+
+class BatchCommandTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        modules = os.path.join(self.tmpdir, 'modules')
+        os.makedirs(modules)
+        with open(os.path.join(modules, 'module'), 'w') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'FOO_USAGE="[--status=number] value"'
+            print >> fp, 'main() {'
+            print >> fp, '    echo "value: ${FOO_ARG_VALUE}"'
+            print >> fp, '    echo "error: ${FOO_ARG_VALUE}" >&2'
+            print >> fp, '    return ${FOO_ARG_STATUS:-0}'
+            print >> fp, '}'
+        with open(os.path.join(modules, 'pymodule.py'), 'w') as fp:
+            print >> fp, 'FOO_HELP = "dummy"'
+            print >> fp, 'def main(args):'
+            print >> fp, '    return 0'
+        self.input = os.path.join(self.tmpdir, 'input')
+        with open(self.input, 'w') as fp:
+            print >> fp, '# comment'
+            print >> fp, 'module a'
+            print >> fp
+            print >> fp, 'module --status 3 "b c"'
+            print >> fp, 'module --lol d'
+            print >> fp, 'pymodule'
+            print >> fp, 'module "e'
+            print >> fp, 'module f'
+        self._search_paths = mock.patch('foo.Runner.search_paths')
+        self._search_paths.start().return_value = [modules]
+        self._log = mock.patch('foo.log')
+        self.log = self._log.start()
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        self._search_paths.stop()
+        self._log.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def run_batch(self, *args):
+        argv = ['foo', 'batch', '--input', self.input] + list(args)
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                with mock.patch('sys.stderr',
+                                new_callable=StringIO) as stderr:
+                    rv = Runner().run()
+        return rv, stdout.getvalue(), stderr.getvalue()
+
+    def test_prefixed(self):
+        rv, stdout, stderr = self.run_batch('--jobs', '2')
+        self.assertEquals(rv, 1)
+        self.assertEquals(sorted(stdout.splitlines()),
+                          ['[1] value: a', '[2] value: b c', '[6] value: f'])
+        stderr = stderr.splitlines()
+        self.assertIn('[1] error: a', stderr)
+        self.assertIn('[2] error: b c', stderr)
+        self.assertIn('[3] foo: error: unrecognized arguments: --lol',
+                      stderr)
+        self.assertIn('[4] only bash modules can run in batch: pymodule',
+                      stderr)
+        self.assertIn('[5] foo: error: No closing quotation', stderr)
+        self.assertEquals(
+            sorted([i[0][0] for i in self.log.error.call_args_list]),
+            ['Job 2 exited with status 3', 'Job 3 exited with status 2',
+             'Job 4 exited with status 1', 'Job 5 exited with status 2'])
+
+    def test_output_dir(self):
+        output_dir = os.path.join(self.tmpdir, 'output')
+        rv, stdout, stderr = self.run_batch('--output-dir', output_dir)
+        self.assertEquals(rv, 1)
+        self.assertEquals(stdout, '')
+        self.assertEquals(stderr, '')
+        self.assertEquals(len(os.listdir(output_dir)), 18)
+        outputs = {}
+        for i in os.listdir(output_dir):
+            with open(os.path.join(output_dir, i)) as fp:
+                outputs[i] = fp.read()
+        self.assertEquals(outputs['1.out'], 'value: a\n')
+        self.assertEquals(outputs['1.err'], 'error: a\n')
+        self.assertEquals(outputs['1.status'], '0\n')
+        self.assertEquals(outputs['2.out'], 'value: b c\n')
+        self.assertEquals(outputs['2.status'], '3\n')
+        self.assertEquals(outputs['3.status'], '2\n')
+        self.assertEquals(outputs['5.status'], '2\n')
+        self.assertEquals(outputs['6.out'], 'value: f\n')
+
+
+class PipeCommandTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        modules = os.path.join(self.tmpdir, 'modules')
+        os.makedirs(modules)
+        for name, usage, body in [
+                ('gen', 'count', 'seq 1 "${FOO_ARG_COUNT}"'),
+                ('filter', 'pattern', 'grep -- "${FOO_ARG_PATTERN}"'),
+                ('first', 'lines', 'head -n "${FOO_ARG_LINES}"'),
+                ('fail', 'status', 'cat > /dev/null; '
+                 'return "${FOO_ARG_STATUS}"'),
+                ('save', 'file', 'cat > "${FOO_ARG_FILE}"')]:
+            with open(os.path.join(modules, name), 'w') as fp:
+                print >> fp, 'FOO_HELP="dummy"'
+                print >> fp, 'FOO_USAGE="%s"' % usage
+                print >> fp, 'main() { %s; }' % body
+        with open(os.path.join(modules, 'pymodule.py'), 'w') as fp:
+            print >> fp, 'FOO_HELP = "dummy"'
+            print >> fp, 'def main(args):'
+            print >> fp, '    return 0'
+        self.output = os.path.join(self.tmpdir, 'output')
+        self.status_file = os.path.join(self.tmpdir, 'status')
+        self._search_paths = mock.patch('foo.Runner.search_paths')
+        self._search_paths.start().return_value = [modules]
+        self._log = mock.patch('foo.log')
+        self.log = self._log.start()
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        self._search_paths.stop()
+        self._log.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipe(self, *args):
+        argv = ['foo', 'pipe', '--status-file', self.status_file] + \
+            list(args) + ['::', 'save', self.output]
+        with mock.patch.object(sys, 'argv', argv):
+            rv = Runner().run()
+        with open(self.output) as fp:
+            output = fp.read()
+        with open(self.status_file) as fp:
+            statuses = [i['status'] for i in json.load(fp)]
+        return rv, output, statuses
+
+    def test_pipe(self):
+        self.assertEquals(self.run_pipe('gen', '30', '::', 'filter', '2'),
+                          (0, '2\n12\n20\n21\n22\n23\n24\n25\n26\n'
+                           '27\n28\n29\n', [0, 0, 0]))
+
+    def test_failed_stage(self):
+        self.assertEquals(self.run_pipe('gen', '3', '::', 'fail', '4'),
+                          (4, '', [0, 4, 0]))
+        self.log.error.assert_called_once_with(
+            'Stage 2 (fail) exited with status 4')
+
+    def test_streaming(self):
+        # the first stage would take ages to finish, if it wasn't killed by
+        # SIGPIPE when the second one exits.
+        self.assertEquals(self.run_pipe('gen', '1000000000', '::', 'first',
+                                        '2'),
+                          (141, '1\n2\n', [141, 0, 0]))
+
+    def test_stages(self):
+        command = foo.PipeCommand(Runner())
+        self.assertEquals(command.stages({'stages': 'a "b c" :: d'}),
+                          [['a', 'b c'], ['d']])
+        self.assertRaises(RuntimeError, command.stages,
+                          {'stages': 'a :: :: d'})
+
+    def test_python_module(self):
+        with mock.patch.object(sys, 'argv', ['foo', 'pipe', 'pymodule', '::',
+                                             'save', self.output]):
+            self.assertRaises(RuntimeError, Runner().run)
+
+    @mock.patch('foo.load_metadata')
+    def test_setup(self, load_metadata):
+        runner = Runner()
+        runner.setup([], ['gen', 'save', 'gen'])
+        self.assertFalse(load_metadata.called)
+        self.assertEquals(sorted(runner.subparser.choices.keys()),
+                          ['gen', 'save'])
+
+
+class SlotsTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.slots = Slots(os.path.join(self.tmpdir, 'slots'))
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_acquire(self):
+        fds = [self.slots.acquire('global', 2) for i in range(2)]
+        self.assertRaises(RuntimeError, self.slots.acquire, 'global', 2,
+                          0.05)
+        self.assertEquals(self.slots.status(),
+                          [{'group': 'global', 'limit': 2, 'running': 2,
+                            'queued': 0}])
+        self.slots.release(fds[:1])
+        fds[0] = self.slots.acquire('global', 2, 0.05)
+        self.slots.release(fds)
+        self.assertEquals(self.slots.status()[0]['running'], 0)
+
+    def test_queued(self):
+        fds = self.slots.acquire_all([('modules/module', 1), ('global', 2)])
+        queued = []
+
+        def wait():
+            fd = self.slots.acquire('modules/module', 1, 5)
+            queued.append(fd)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        start = _time()
+        while self.slots.status()[1]['queued'] == 0:
+            self.assertLess(_time() - start, 5)
+            _sleep(0.01)
+        self.assertEquals(self.slots.status(),
+                          [{'group': 'global', 'limit': 2, 'running': 1,
+                            'queued': 0},
+                           {'group': 'modules/module', 'limit': 1,
+                            'running': 1, 'queued': 1}])
+        self.slots.release(fds)
+        thread.join()
+        self.assertEquals(len(queued), 1)
+        self.assertEquals(self.slots.status()[1],
+                          {'group': 'modules/module', 'limit': 1,
+                           'running': 1, 'queued': 0})
+        self.slots.release(queued)
+
+    def test_stale_queue(self):
+        fd = self.slots.acquire('global', 1)
+        queue = os.path.join(self.tmpdir, 'slots', 'global', 'queue')
+        os.makedirs(queue)
+        with open(os.path.join(queue, '1-dead'), 'w'):
+            pass
+        self.assertEquals(self.slots.status()[0]['queued'], 0)
+        self.assertEquals(os.listdir(queue), [])
+        self.slots.release([fd])
+
+    def test_inherit(self):
+        fd = self.slots.acquire('global', 1)
+        self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+        self.slots.release([fd])
+        fd = self.slots.acquire('global', 1, inherit=True)
+        self.assertFalse(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+        self.slots.release([fd])
+
+    @mock.patch('foo.Runner.modules')
+    def test_runner(self, modules):
+        module = os.path.join(self.tmpdir, 'module')
+        with open(module, 'w') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'FOO_MAX_CONCURRENCY=1'
+            print >> fp, 'main() { return 3; }'
+        modules.return_value = {'module': BashModule(module)}
+        environ = {'FOO_CACHE_DIR': self.tmpdir, 'FOO_MAX_CONCURRENCY': '4'}
+        with mock.patch.dict(os.environ, environ):
+            runner = Runner()
+            runner.setup(['module'])
+            raw_args = runner.parser.parse_args(['--queue-timeout=0.05',
+                                                 'module'])
+            runner.queue_timeout = raw_args._queue_timeout
+            args = runner.build_args(raw_args)
+            self.assertEquals(runner.slot_limits(raw_args._module),
+                              [('modules/module', 1), ('global', 4)])
+            self.assertEquals(runner.dispatch(raw_args._module, args,
+                                              raw_args), 3)
+            fd = self.slots.acquire('modules/module', 1)
+            try:
+                self.assertRaises(RuntimeError, runner.dispatch,
+                                  raw_args._module, args, raw_args)
+            finally:
+                self.slots.release([fd])
+            with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                with mock.patch.object(sys, 'argv', ['foo', 'slots']):
+                    self.assertEquals(Runner().run(), 0)
+        self.assertEquals(stdout.getvalue().split('\n'), [
+            'global                         0/4 running, 0 queued',
+            'modules/module                 0/1 running, 0 queued',
+            ''])
+
+
+class ServerTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmpdir, 'foo.sock')
+        modules = os.path.join(self.tmpdir, 'modules')
+        os.makedirs(modules)
+        with open(os.path.join(modules, 'module'), 'w') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'FOO_USAGE="[--bar=baz]"'
+            print >> fp, 'main() {'
+            print >> fp, '    echo "bar: ${FOO_ARG_BAR} home: ${HOME}"'
+            print >> fp, '    pwd'
+            print >> fp, '    cat'
+            print >> fp, '    log_error "lol"'
+            print >> fp, '    return 3'
+            print >> fp, '}'
+        with open(os.path.join(modules, 'cached'), 'w') as fp:
+            print >> fp, 'FOO_HELP="dummy"'
+            print >> fp, 'FOO_CACHE_TTL="60"'
+            print >> fp, 'main() { date; }'
+        with open(os.path.join(modules, 'pymodule.py'), 'w') as fp:
+            print >> fp, 'FOO_HELP = "dummy"'
+            print >> fp, 'def main(args):'
+            print >> fp, '    return 0'
+        with mock.patch('foo.Runner.search_paths') as search_paths:
+            search_paths.return_value = [modules]
+            self.server = foo.Server(self.socket, workers=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        while not os.path.exists(self.socket):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        self.server.close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def run_client(self, argv, stdin=''):
+        stdin_file = tempfile.TemporaryFile()
+        stdin_file.write(stdin)
+        stdin_file.seek(0)
+        stdout, stderr = StringIO(), StringIO()
+        rv = foo.run_client(argv, self.socket, stdin_file, stdout, stderr)
+        return rv, stdout.getvalue(), stderr.getvalue()
+
+    def test_run(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            rv, stdout, stderr = self.run_client(['module', '--bar', 'baz'],
+                                                 'input\n')
+        finally:
+            os.chdir(cwd)
+        self.assertEquals(rv, 3)
+        self.assertEquals(stdout.splitlines(),
+                          ['bar: baz home: ',
+                           os.path.realpath(self.tmpdir), 'input'])
+        self.assertIn('lol', stderr)
+
+    def test_parse_error(self):
+        rv, stdout, stderr = self.run_client(['module', '--lol'])
+        self.assertEquals(rv, 2)
+        self.assertEquals(stdout, '')
+        self.assertIn('unrecognized arguments: --lol', stderr)
+
+    def test_help(self):
+        rv, stdout, stderr = self.run_client(['--help'])
+        self.assertEquals(rv, 0)
+        self.assertIn('module', stdout)
+
+    def test_fallback(self):
+        self.assertIsNone(self.run_client(['pymodule'])[0])
+        self.assertIsNone(self.run_client(['compile'])[0])
+        self.assertIsNone(self.run_client(['cached'])[0])
+
+    def test_slots(self):
+        slots = foo.Slots(os.path.join(foo.get_cache_dir(), 'slots'))
+        fd = slots.acquire('global', 1)
+        try:
+            with mock.patch.dict(os.environ, {'FOO_MAX_CONCURRENCY': '1',
+                                              'FOO_QUEUE_TIMEOUT': '0.1'}):
+                rv, stdout, stderr = self.run_client(['module'])
+        finally:
+            slots.release([fd])
+        self.assertEquals(rv, 1)
+        self.assertEquals(stdout, '')
+        self.assertIn('Timed out waiting for a free slot of global', stderr)
+        with mock.patch.dict(os.environ, {'FOO_MAX_CONCURRENCY': '1'}):
+            self.assertEquals(self.run_client(['module'])[0], 3)
+        # released when the job exits
+        slots.release([slots.acquire('global', 1, timeout=0)])
+
+    def test_no_server(self):
+        self.assertIsNone(foo.run_client(
+            ['module'], os.path.join(self.tmpdir, 'lol.sock')))
+
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'modules')
+
+# the python engine of the dns module
+dns_engine = PythonModule(os.path.join(MODULES_DIR,
+                                        'dns-resolve.py')).load()
+Resolver = dns_engine['Resolver']
+
+
+class StubDNSServer(object):
+
+    # answers queries over udp on localhost from a dict of records, like
+    # {('example.com', 'A'): [(300, '10.0.0.1')]}. aliases are followed like
+    # a recursive resolver would do. names without records get NXDOMAIN.
+    # the first queries may be dropped, to test retries.
+
+    def __init__(self, records, drop=0, delay=0):
+        self.records = records
+        self.drop = drop
+        self.delay = delay
+        self.queries = []
+        self.closed = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.05)
+        self.address = '%s:%d' % self.sock.getsockname()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def encode_name(self, name):
+        return ''.join([chr(len(i)) + i for i in name.split('.')]) + '\0'
+
+    def encode_rdata(self, rtype, data):
+        if rtype == 'A':
+            return socket.inet_aton(data)
+        if rtype == 'MX':
+            return struct.pack('!H', data[0]) + self.encode_name(data[1])
+        return self.encode_name(data)
+
+    def encode_record(self, name, rtype, ttl, data):
+        rdata = self.encode_rdata(rtype, data)
+        rtype = dns_engine['DNS_TYPES'][rtype]
+        return self.encode_name(name) + struct.pack(
+            '!HHIH', rtype, 1, ttl, len(rdata)) + rdata
+
+    def answer(self, data):
+        qid = struct.unpack_from('!H', data)[0]
+        name, offset = dns_engine['dns_read_name'](data, 12)
+        rtype = struct.unpack_from('!H', data, offset)[0]
+        rtype = dns_engine['DNS_TYPE_NAMES'][rtype]
+        self.queries.append((name, rtype))
+        records = []
+        rcode = 3
+        while True:
+            if any([i[0] == name for i in self.records]):
+                rcode = 0
+            cnames = self.records.get((name, 'CNAME'), [])
+            if not cnames or rtype == 'CNAME':
+                break
+            records.append(self.encode_record(name, 'CNAME', *cnames[0]))
+            name = cnames[0][1]
+        for ttl, value in self.records.get((name, rtype), []):
+            records.append(self.encode_record(name, rtype, ttl, value))
+        return struct.pack('!HHHHHH', qid, 0x8180 | rcode, 1, len(records),
+                           0, 0) + data[12:offset + 4] + ''.join(records)
+
+    def serve(self):
+        while not self.closed:
+            try:
+                data, address = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            if self.drop > 0:
+                self.drop -= 1
+                continue
+            _sleep(self.delay)
+            self.sock.sendto(self.answer(data), address)
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.sock.close()
+
+
+EXAMPLE_RECORDS = {
+    ('www.example.com', 'CNAME'): [(300, 'example.com')],
+    ('example.com', 'A'): [(300, '10.0.0.2'), (120, '10.0.0.1')],
+    ('example.com', 'NS'): [(300, 'ns1.example.net'),
+                            (300, 'ns2.example.net')],
+    ('example.com', 'MX'): [(300, (20, 'mx2.example.net')),
+                            (300, (10, 'mx1.example.net'))],
+    ('ns1.example.net', 'A'): [(300, '10.1.0.1')],
+    ('ns2.example.net', 'CNAME'): [(300, 'ns.example.org')],
+    ('ns.example.org', 'A'): [(300, '10.1.0.2')],
+    ('mx1.example.net', 'A'): [(300, '10.1.0.1')],
+    ('mx2.example.net', 'A'): [(300, '10.1.0.3')],
+    ('1.0.0.10.in-addr.arpa', 'PTR'): [(300, 'one.example.com')],
+}
+
+EXAMPLE_REPORT = '''\
+Hostname: www.example.com
+CNAME: example.com
+
+A records:
+    10.0.0.1 -> one.example.com
+    10.0.0.2
+
+NS records:
+    ns1.example.net
+        10.1.0.1
+    ns2.example.net(CNAME: ns.example.org)
+        10.1.0.2
+
+MX records:
+    mx1.example.net (Priority: 10)
+        10.1.0.1
+    mx2.example.net (Priority: 20)
+        10.1.0.3'''
+
+
+class ResolverTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.server = StubDNSServer(EXAMPLE_RECORDS)
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        self.server.close()
+
+    def test_parse_address(self):
+        self.assertEquals(Resolver.parse_address('10.0.0.1'),
+                          ('10.0.0.1', 53))
+        self.assertEquals(Resolver.parse_address('10.0.0.1:5353'),
+                          ('10.0.0.1', 5353))
+        self.assertEquals(Resolver.parse_address('::1'), ('::1', 53))
+        self.assertEquals(Resolver.parse_address('[::1]:5353'),
+                          ('::1', 5353))
+
+    def test_query(self):
+        resolver = Resolver([self.server.address], timeout=1)
+        results = resolver.query([('www.example.com', 'A'),
+                                  ('example.com', 'MX'),
+                                  ('lol.example.com', 'A')])
+        resolver.close()
+        self.assertEquals(results[('www.example.com', 'A')],
+                          (0, [('www.example.com', 300, 'CNAME',
+                                'example.com'),
+                               ('example.com', 300, 'A', '10.0.0.2'),
+                               ('example.com', 120, 'A', '10.0.0.1')], []))
+        self.assertEquals(results[('example.com', 'MX')][1],
+                          [('example.com', 300, 'MX',
+                            (20, 'mx2.example.net')),
+                           ('example.com', 300, 'MX',
+                            (10, 'mx1.example.net'))])
+        self.assertEquals(results[('lol.example.com', 'A')], (3, [], []))
+        self.assertEquals(resolver.sent, 3)
+
+    def test_query_retry(self):
+        self.server.drop = 1
+        resolver = Resolver([self.server.address], timeout=0.1, retries=1)
+        results = resolver.query([('example.com', 'A')])
+        resolver.close()
+        self.assertEquals(results[('example.com', 'A')][0], 0)
+        self.assertEquals(resolver.sent, 2)
+
+    def test_query_timeout(self):
+        self.server.drop = 3
+        resolver = Resolver([self.server.address], timeout=0.05, retries=2)
+        results = resolver.query([('example.com', 'A')])
+        resolver.close()
+        self.assertEquals(results, {('example.com', 'A'): None})
+        self.assertEquals(resolver.sent, 3)
+
+    def test_query_max_pending(self):
+        resolver = Resolver([self.server.address], timeout=1, max_pending=2)
+        queries = [(i[0], 'A') for i in EXAMPLE_RECORDS]
+        results = resolver.query(queries)
+        resolver.close()
+        self.assertEquals(sorted(results.keys()), sorted(set(queries)))
+        self.assertNotIn(None, results.values())
+        self.assertEquals(resolver.sent, len(set(queries)))
+
+    def test_query_fqdn(self):
+        resolver = Resolver([self.server.address], timeout=0.1, retries=0)
+        results = resolver.query([('example.com.', 'A')])
+        resolver.close()
+        self.assertEquals(results[('example.com.', 'A')][1],
+                          [('example.com', 300, 'A', '10.0.0.2'),
+                           ('example.com', 120, 'A', '10.0.0.1')])
+
+    def test_hostname(self):
+        self.assertEquals(
+            dns_engine['dns_hostname']('https://WWW.example.com./foo'),
+            'www.example.com')
+
+    def test_query_invalid_name(self):
+        resolver = Resolver([self.server.address])
+        results = resolver.query([('lol..example.com', 'A')])
+        resolver.close()
+        self.assertEquals(results, {('lol..example.com', 'A'): None})
+        self.assertEquals(resolver.sent, 0)
+
+    def test_report(self):
+        resolver = Resolver([self.server.address], timeout=1)
+        results = dns_engine['dns_resolve'](resolver, ['www.example.com'])
+        resolver.close()
+        report = dns_engine['dns_report'](results, 'www.example.com')
+        self.assertEquals(dns_engine['dns_report_text'](report),
+                          EXAMPLE_REPORT)
+        self.assertEquals(
+            sorted(results.keys()),
+            sorted(set(dns_engine['dns_report_queries'](report))))
+        self.assertEquals(report['mx'][0],
+                          {'hostname': 'mx1.example.net', 'priority': 10,
+                           'cname': '', 'a': [{'address': '10.1.0.1',
+                                               'ptr': ''}]})
+        # 3 for the hostname, 4 for the NS and MX hosts, 5 PTRs
+        self.assertEquals(resolver.sent, 12)
+
+    def run_module(self, *args):
+        argv = ['foo', 'dns-resolve', '--nameservers',
+                self.server.address] + list(args)
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('foo.search_paths') as search_paths:
+                search_paths.return_value = [MODULES_DIR]
+                with mock.patch('sys.stdout', new_callable=StringIO) as out:
+                    self.assertEquals(Runner().run(), 0)
+        return out.getvalue()
+
+    def test_module(self):
+        self.assertEquals(self.run_module('http://www.example.com/lol'),
+                          EXAMPLE_REPORT + '\n')
+
+    def test_module_json(self):
+        input = os.path.join(_cache_dir, 'input')
+        with open(input, 'w') as fp:
+            print >> fp, 'www.example.com'
+            print >> fp
+            print >> fp, 'https://lol.example.com/'
+        output = self.run_module('--json', '--window', '1', '--input', input)
+        reports = [json.loads(i) for i in output.splitlines()]
+        self.assertEquals([i['hostname'] for i in reports],
+                          ['www.example.com', 'lol.example.com'])
+        self.assertEquals(reports[1], {'hostname': 'lol.example.com',
+                                       'cname': '', 'a': [], 'ns': [],
+                                       'mx': []})
+
+    def watch(self, sleep, *args):
+        with mock.patch('time.sleep') as _sleep:
+            _sleep.side_effect = sleep
+            output = self.run_module('--watch', '--json', 'www.example.com',
+                                     *args)
+        return [json.loads(i) for i in output.splitlines()]
+
+    def test_watch(self):
+        def sleep(seconds):
+            if self.server.records is not EXAMPLE_RECORDS:
+                raise KeyboardInterrupt
+            self.server.records = dict(EXAMPLE_RECORDS)
+            del self.server.records[('example.com', 'MX')]
+            self.server.records[('example.com', 'A')] = [(300, '10.0.0.3')]
+            _sleep(seconds)
+        output = self.watch(sleep, '--interval', '0.01')
+        self.assertEquals(len(output), 2)
+        self.assertEquals(output[0]['hostname'], 'www.example.com')
+        self.assertEquals(output[0]['a'][0]['ptr'], 'one.example.com')
+        self.assertEquals(output[1]['added'],
+                          [['www.example.com', 'A', '10.0.0.3']])
+        self.assertEquals(output[1]['removed'],
+                          [['10.0.0.1', 'PTR', 'one.example.com'],
+                           ['mx1.example.net', 'A', '10.1.0.1'],
+                           ['mx2.example.net', 'A', '10.1.0.3'],
+                           ['www.example.com', 'A', '10.0.0.1'],
+                           ['www.example.com', 'A', '10.0.0.2'],
+                           ['www.example.com', 'MX', '10 mx1.example.net'],
+                           ['www.example.com', 'MX', '20 mx2.example.net']])
+
+    def test_watch_ttl(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            raise KeyboardInterrupt
+        output = self.watch(sleep)
+        self.assertEquals(len(output), 1)
+        # smallest TTL, from one of the A records
+        self.assertTrue(119 < sleeps[0] <= 120)
+
+
+# a `host' command answering like `host -v', from a fixed zone. it logs its
+# arguments to host.log next to itself, and takes a second to answer slow.*
+# names.
+STUB_HOST = '''#!/bin/bash
+echo "$*" >> "${0%/*}/host.log"
+[[ "$1" == -v ]] && shift
+if [[ "$1" == -t ]]; then type="$2"; name="$3"; else type=ANY; name="$1"; fi
+[[ "${name}" == slow.* ]] && sleep 1
+alias_of() {
+    case "$1" in
+        www.example.com) echo example.com ;;
+        ns2.example.net) echo ns.example.org ;;
+        a.example.com) echo b.example.com ;;
+        b.example.com) echo c.example.com ;;
+    esac
+}
+section() {
+    local name="$1" type="$2" alias
+    echo "Trying \"${name}\""
+    echo ";; ->>HEADER<<- opcode: QUERY, status: NOERROR, id: 1"
+    echo
+    echo ";; QUESTION SECTION:"
+    echo ";${name}. IN ${type}"
+    echo
+    echo ";; ANSWER SECTION:"
+    alias="$(alias_of "${name}")"
+    while [[ "${type}" != PTR && -n "${alias}" ]]; do
+        echo "${name}. 300 IN CNAME ${alias}."
+        name="${alias}"
+        alias="$(alias_of "${name}")"
+    done
+    case "${type}:${name}" in
+        A:example.com|A:c.example.com)
+            echo "${name}. 300 IN A 10.0.0.2"
+            echo "${name}. 120 IN A 10.0.0.1" ;;
+        NS:example.com)
+            echo "example.com. 300 IN NS ns1.example.net."
+            echo "example.com. 300 IN NS ns2.example.net." ;;
+        MX:example.com)
+            echo "example.com. 300 IN MX 20 mx2.example.net."
+            echo "example.com. 300 IN MX 10 mx1.example.net." ;;
+        A:ns*|A:mx*)
+            echo "${name}. 300 IN A 10.1.0.${#name}" ;;
+        PTR:10.0.0.1)
+            echo "1.0.0.10.in-addr.arpa. 300 IN PTR one.example.com." ;;
+    esac
+    echo
+    echo ";; ADDITIONAL SECTION:"
+    echo "ns1.example.net. 300 IN A 10.9.9.9"
+    echo
+    echo "Received 100 bytes from 127.0.0.1#53 in 1 ms"
+}
+if [[ "${type}" == ANY ]]; then
+    section "${name}" A
+    section "${name}" AAAA
+    section "${name}" MX
+else
+    section "${name}" "${type}"
+fi
+'''
+
+
+class DNSModuleTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        with open(os.path.join(bindir, 'host'), 'w') as fp:
+            fp.write(STUB_HOST)
+        os.chmod(os.path.join(bindir, 'host'), 0755)
+        self.host_log = os.path.join(bindir, 'host.log')
+        self._environ = mock.patch.dict(os.environ, {
+            'PATH': '%s:%s' % (bindir, os.environ['PATH']),
+            'FOO_CACHE_DIR': os.path.join(self.tmpdir, 'cache')})
+        self._environ.start()
+        self.module = BashModule(os.path.join(MODULES_DIR, 'dns'))
+
+    def tearDown(self):
+        super(BaseTestCase, self).tearDown()
+        self._environ.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def run_dns(self, hostname='', **kwargs):
+        args = {'engine': 'host', 'jobs': '', 'bypass_cache': '',
+                'flush_cache': '', 'batch': '', 'input': '', 'watch': '',
+                'interval': '', 'url_or_hostname': hostname,
+                'log_level': '10'}
+        args.update(kwargs)
+        stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        try:
+            rv = self.module.run(args, stdout=stdout, stderr=stderr)
+            stdout.seek(0)
+            stderr.seek(0)
+            return rv, stdout.read(), stderr.read()
+        finally:
+            stdout.close()
+            stderr.close()
+
+    def host_calls(self):
+        if not os.path.exists(self.host_log):
+            return 0
+        with open(self.host_log) as fp:
+            return len(fp.readlines())
+
+    def test_report(self):
+        rv, stdout, stderr = self.run_dns('http://www.example.com/foo')
+        self.assertEquals(rv, 0)
+        self.assertEquals(stdout, '''\
+Hostname: www.example.com
+CNAME: example.com
+
+A records:
+    10.0.0.1 -> one.example.com
+    10.0.0.2
+
+NS records:
+    ns1.example.net
+        10.1.0.15
+    ns2.example.net(CNAME: ns.example.org)
+        10.1.0.14
+
+MX records:
+    mx1.example.net (Priority: 10)
+        10.1.0.15
+    mx2.example.net (Priority: 20)
+        10.1.0.15
+''')
+        self.assertIn('foo.dns - DEBUG: www.example.com: host calls: 10 '
+                      'made, 8 saved, 0 cached.', stderr.splitlines())
+        self.assertEquals(self.host_calls(), 10)
+
+        # the second run is answered from the cache
+        rv, stdout2, stderr = self.run_dns('www.example.com')
+        self.assertEquals(stdout2, stdout)
+        self.assertIn('foo.dns - DEBUG: www.example.com: host calls: 0 '
+                      'made, 8 saved, 10 cached.', stderr.splitlines())
+        self.assertEquals(self.host_calls(), 10)
+
+    def test_report_cname_chain(self):
+        rv, stdout, stderr = self.run_dns('a.example.com')
+        self.assertEquals(stdout.splitlines()[:2],
+                          ['Hostname: a.example.com', 'CNAME: b.example.com'])
+
+    def test_batch(self):
+        input = os.path.join(self.tmpdir, 'input')
+        with open(input, 'w') as fp:
+            print >> fp, 'slow.example.com'
+            print >> fp, 'a.example.com'
+            print >> fp, 'www.example.com'
+        rv, stdout, stderr = self.run_dns(input=input)
+        self.assertEquals(rv, 0)
+        reports = [json.loads(i) for i in stdout.splitlines()]
+
+        # each report is printed as soon as its job finishes
+        self.assertEquals(sorted(i['hostname'] for i in reports[:2]),
+                          ['a.example.com', 'www.example.com'])
+        self.assertEquals(reports[2], {'hostname': 'slow.example.com',
+                                       'cname': '', 'a': [], 'ns': [],
+                                       'mx': []})
+        a = [{'address': '10.0.0.1', 'ptr': 'one.example.com'},
+             {'address': '10.0.0.2', 'ptr': ''}]
+        self.assertIn({'hostname': 'a.example.com', 'cname': 'b.example.com',
+                       'a': a, 'ns': [], 'mx': []}, reports)
+        self.assertIn({
+            'hostname': 'www.example.com', 'cname': 'example.com', 'a': a,
+            'ns': [{'hostname': 'ns1.example.net', 'cname': '',
+                    'a': [{'address': '10.1.0.15', 'ptr': ''}]},
+                   {'hostname': 'ns2.example.net', 'cname': 'ns.example.org',
+                    'a': [{'address': '10.1.0.14', 'ptr': ''}]}],
+            'mx': [{'hostname': 'mx1.example.net', 'priority': 10,
+                    'cname': '', 'a': [{'address': '10.1.0.15', 'ptr': ''}]},
+                   {'hostname': 'mx2.example.net', 'priority': 20,
+                    'cname': '', 'a': [{'address': '10.1.0.15', 'ptr': ''}]}]},
+            reports)
 
 
 class MainTestCase(BaseTestCase):
@@ -310,6 +1927,31 @@ class MainTestCase(BaseTestCase):
             with self.assertRaises(RuntimeError):
                 main()
 
+    @mock.patch('foo.signal.signal')
+    @mock.patch('foo.run_client')
+    @mock.patch('foo.Server')
+    @mock.patch('foo.Runner.run')
+    def test_module_options(self, run, Server, run_client, signal_):
+        # --server, --client and --socket of a module aren't foo's
+        run.return_value = 0
+        run_client.return_value = None
+        with mock.patch.dict(os.environ, {'FOO_SOCKET': '/foo.sock'}):
+            with mock.patch.object(sys, 'argv', ['foo', 'svc', '--server',
+                                                 'db1', '--client', 'h1']):
+                self.assertEquals(main(), 0)
+            self.assertFalse(Server.called)
+            self.assertFalse(run_client.called)
+            with mock.patch.object(sys, 'argv', ['foo', '--client', 'svc',
+                                                 '--socket', '/bar.sock']):
+                self.assertEquals(main(), 0)
+            run_client.assert_called_once_with(
+                ['--client', 'svc', '--socket', '/bar.sock'], '/foo.sock')
+            Server.return_value.serve_forever.return_value = 0
+            with mock.patch.object(sys, 'argv', ['foo', '--socket',
+                                                 '/bar.sock', '--server']):
+                self.assertEquals(main(), 0)
+            Server.assert_called_once_with('/bar.sock')
+
 
 if __name__ == '__main__':
     unittest.main()